@@ -0,0 +1,58 @@
+""" Selects which beams of a laser scan are used in the sensor update.  Using fewer beams trades
+    accuracy for update latency, and reading the beam bearings from the scan (instead of assuming a
+    360 beam scan indexed by degree) lets the filter run on lidars of any resolution. """
+
+import numpy as np
+
+from sensor_model import valid_beams
+
+
+class BeamSelector(object):
+    """ Picks a subset of the beams of a sensor_msgs/LaserScan
+        Attributes:
+            stride: use every stride-th beam of the scan
+            max_beams: the maximum number of beams to use (0 or None for no limit).  If more beams
+                       survive the other stages, evenly spaced ones are kept.
+            informative: if True, drop beams that hit the sensor's maximum range (which carry little
+                         information) and beams whose endpoints nearly coincide with an earlier beam's
+            duplicate_tolerance: the distance (in meters) below which two endpoints count as duplicates
+    """
+
+    def __init__(self, stride=1, max_beams=None, informative=False, duplicate_tolerance=0.05):
+        if stride < 1:
+            raise ValueError("beam stride must be at least 1")
+        self.stride = int(stride)
+        self.max_beams = max_beams
+        self.informative = informative
+        self.duplicate_tolerance = duplicate_tolerance
+
+    def select(self, msg):
+        """ Select the beams to use from a scan
+            msg: a sensor_msgs/LaserScan
+            returns: a tuple of arrays (ranges, angles) of the selected beams, where the angles are the
+                     bearings of the beams in the laser frame """
+        ranges = np.asarray(msg.ranges, dtype=np.float64)[::self.stride]
+        angles = msg.angle_min + msg.angle_increment*np.arange(0, len(msg.ranges), self.stride)
+        ranges, angles = valid_beams(ranges, angles, msg.range_min, msg.range_max)
+
+        if self.informative:
+            ranges, angles = self._informative_beams(ranges, angles, msg.range_max)
+
+        if self.max_beams and len(ranges) > self.max_beams:
+            keep = np.unique(np.linspace(0, len(ranges) - 1, self.max_beams).round().astype(np.intp))
+            ranges, angles = ranges[keep], angles[keep]
+        return ranges, angles
+
+    def _informative_beams(self, ranges, angles, range_max):
+        """ Drop max-range returns and returns whose endpoints fall in the same duplicate_tolerance
+            sized cell as an earlier beam's endpoint """
+        not_max_range = ranges < range_max - 1e-3
+        ranges, angles = ranges[not_max_range], angles[not_max_range]
+        if self.duplicate_tolerance <= 0 or not len(ranges):
+            return ranges, angles
+
+        cell_x = np.floor(ranges*np.cos(angles)/self.duplicate_tolerance).astype(np.int64)
+        cell_y = np.floor(ranges*np.sin(angles)/self.duplicate_tolerance).astype(np.int64)
+        _, first = np.unique(cell_x*(1 << 32) + cell_y, return_index=True)
+        first.sort()
+        return ranges[first], angles[first]
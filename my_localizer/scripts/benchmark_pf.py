@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+""" Offline replay harness and benchmark for the particle filter.  It runs without roscore:
+    maps are loaded straight from the maps/*.yaml and .pgm files, and the filter core is fed
+    either a synthetic sequence (a random walk through the free space of the map, with scans
+    ray cast from the true poses) or a sequence recorded earlier with --save-sequence.
+
+    For every map and particle count it reports the mean time of each filter stage, the number
+    of scans processed per second and the error of the pose estimate against the ground truth.
+    With --workers it also reports how the parallel likelihood backend scales with the number of
+    workers for the likelihood field, coarse to fine and beam models, and checks that each of them
+    gives exactly the single core weights.
+
+    Example:
+        ./benchmark_pf.py --maps ../maps/ac109_1.yaml --particles 500 5000 50000 --steps 50
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import math
+import os
+import time
+
+import numpy as np
+
+from map_io import load_map
+from occupancy_field import OccupancyField
+from filter_core import ParticleFilterCore
+from particle_set import ParticleSet
+from beam_selection import BeamSelector
+from sensor_model import LikelihoodFieldModel, CoarseToFineModel, BeamRangeModel
+from range_table import RangeTable
+from field_pyramid import DistanceFieldPyramid
+from parallel_likelihood import ParallelLikelihoodModel
+from motion_model import angle_normalize
+from raycast import cast_rays
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps')
+STAGES = ('odom', 'laser', 'pose', 'resample')
+
+
+class Scan(object):
+    """ A stand in for sensor_msgs/LaserScan with the fields the filter uses """
+    def __init__(self, ranges, angle_min, angle_increment, range_min, range_max):
+        self.ranges = ranges
+        self.angle_min = angle_min
+        self.angle_increment = angle_increment
+        self.range_min = range_min
+        self.range_max = range_max
+
+
+def compose(xy_theta, motion):
+    """ Apply a motion (dx, dy, dtheta) expressed in the frame of the pose xy_theta """
+    x, y, theta = xy_theta
+    return (x + motion[0]*math.cos(theta) - motion[1]*math.sin(theta),
+            y + motion[0]*math.sin(theta) + motion[1]*math.cos(theta),
+            float(angle_normalize(theta + motion[2])))
+
+
+def synthetic_sequence(field, n_steps, n_beams=360, max_range=5.0, step_size=0.15, clearance=0.2,
+                       odom_noise=0.05, random_state=None):
+    """ Drive a simulated robot on a random walk through the free space of a map
+        field: the OccupancyField of the map
+        n_steps: the number of poses in the sequence
+        n_beams: the number of beams in each scan, evenly spaced over a full circle
+        max_range: the maximum range of the simulated lidar.  Beams without a return read 0, like a Neato's.
+        step_size: how far the robot drives between scans
+        clearance: how close the robot is allowed to get to an obstacle
+        odom_noise: the relative noise of the odometry
+        returns: a dict with the ground truth and odometry poses as (n_steps, 3) arrays, the scans as an
+                 (n_steps, n_beams) array and the scan geometry """
+    random_state = np.random.RandomState(random_state)
+    info = field.map.info
+    grid = np.asarray(field.map.data).reshape((info.height, info.width))
+    rows, cols = np.nonzero((grid == 0) & (field.closest_occ > clearance))
+    if not len(rows):
+        raise ValueError("the map has no free space with %.2f m of clearance" % clearance)
+
+    def cell_center(i):
+        return (info.origin.position.x + (cols[i] + 0.5)*info.resolution,
+                info.origin.position.y + (rows[i] + 0.5)*info.resolution)
+
+    def is_clear(x, y):
+        distance = field.get_closest_obstacle_distance(x, y)
+        col = int((x - info.origin.position.x)/info.resolution)
+        row = int((y - info.origin.position.y)/info.resolution)
+        return not math.isnan(distance) and distance > clearance and grid[row, col] == 0
+
+    x, y = cell_center(random_state.randint(len(rows)))
+    truth = [(x, y, random_state.uniform(-math.pi, math.pi))]
+    odom = [(0.0, 0.0, 0.0)]
+    for _ in range(n_steps - 1):
+        # turn a little, then drive forward if that keeps us in free space (otherwise just turn)
+        turn = random_state.normal(0.0, 0.3)
+        forward = step_size
+        candidate = compose(truth[-1], (forward, 0.0, turn))
+        if not is_clear(candidate[0], candidate[1]):
+            forward = 0.0
+            turn = random_state.uniform(math.pi/4, math.pi)
+            candidate = compose(truth[-1], (0.0, 0.0, turn))
+        truth.append(candidate)
+
+        # the odometry integrates a noisy version of the same motion
+        odom.append(compose(odom[-1], (forward*(1 + random_state.normal(0.0, odom_noise)),
+                                       forward*random_state.normal(0.0, odom_noise),
+                                       turn*(1 + random_state.normal(0.0, odom_noise)))))
+
+    truth = np.array(truth)
+    angle_increment = 2*math.pi/n_beams
+    angles = np.arange(n_beams)*angle_increment
+    ranges = cast_rays(field, truth[:, 0:1], truth[:, 1:2], truth[:, 2:3] + angles, max_range)
+    ranges[~np.isfinite(ranges)] = 0.0
+    return {'truth': truth, 'odom': np.array(odom), 'ranges': ranges, 'angle_min': 0.0,
+            'angle_increment': angle_increment, 'range_min': 0.0, 'range_max': max_range}
+
+
+def save_sequence(path, sequence):
+    """ Save a sequence (see synthetic_sequence) to a .npz file, so it can be replayed later """
+    np.savez(path, **sequence)
+
+
+def load_sequence(path):
+    """ Load a sequence saved with save_sequence (or recorded in the same format from a robot) """
+    with np.load(path) as data:
+        return dict((key, data[key]) for key in data.files)
+
+
+def run_filter(field, sequence, n_particles, beam_stride=10, kld_sampling=False, resample_threshold=0.5,
+               global_init=False, kidnap_step=None, recovery_alpha_slow=0.001, coarse_to_fine=False,
+               range_table=None, random_state=None):
+    """ Replay a sequence through the filter core, timing every stage of every update
+        global_init: if True the particles start spread over the whole map instead of near the true pose
+        kidnap_step: if given, the particles are moved to a random spot of the map at this step, as if the
+                     robot had been picked up and carried there without the filter noticing
+        coarse_to_fine: if True the particles are scored coarse to fine on a DistanceFieldPyramid
+        range_table: if given, the particles are scored with the beam model on this RangeTable
+        returns: a dict with the mean time of each stage (in seconds), the number of scans processed per
+                 second and the mean and final position (meters) and heading (radians) errors """
+    sensor_model = LikelihoodFieldModel(field)
+    if range_table is not None:
+        sensor_model = BeamRangeModel(range_table)
+    elif coarse_to_fine:
+        sensor_model = CoarseToFineModel(sensor_model, DistanceFieldPyramid(field))
+    core = ParticleFilterCore(field, n_particles=n_particles, sensor_model=sensor_model,
+                              beam_selector=BeamSelector(stride=beam_stride),
+                              kld_sampling=kld_sampling, max_particles=max(n_particles, 5000),
+                              resample_threshold=resample_threshold, recovery_alpha_slow=recovery_alpha_slow,
+                              random_state=random_state)
+    truth = sequence['truth']
+    odom = sequence['odom']
+    if global_init:
+        core.initialize_particle_cloud_globally(n_particles)
+    else:
+        core.initialize_particle_cloud(truth[0], lin_noise=0.5, ang_noise=math.pi/4)
+
+    timings = dict((stage, []) for stage in STAGES)
+    position_errors = []
+    heading_errors = []
+    for t in range(1, len(truth)):
+        if t == kidnap_step:
+            elsewhere = ParticleSet.in_free_space(field, 1, core.random_state)
+            core.particle_cloud = ParticleSet.around_pose((elsewhere.x[0], elsewhere.y[0], elsewhere.theta[0]),
+                                                          len(core.particle_cloud), 0.5, math.pi/4, core.random_state)
+        scan = Scan(sequence['ranges'][t], float(sequence['angle_min']), float(sequence['angle_increment']),
+                    float(sequence['range_min']), float(sequence['range_max']))
+        stages = ((lambda: core.update_particles_with_odom(odom[t-1], odom[t])),
+                  (lambda: core.update_particles_with_laser(scan)),
+                  core.update_robot_pose,
+                  core.resample_if_degenerate)
+        for stage, run in zip(STAGES, stages):
+            start = time.time()
+            run()
+            timings[stage].append(time.time() - start)
+
+        x, y, theta = core.robot_xy_theta
+        position_errors.append(math.hypot(x - truth[t, 0], y - truth[t, 1]))
+        heading_errors.append(abs(float(angle_normalize(theta - truth[t, 2]))))
+
+    total = sum(sum(times) for times in timings.values())
+    result = dict((stage, np.mean(times)) for stage, times in timings.items())
+    result.update({'scans_per_sec': (len(truth) - 1)/total if total > 0 else float('inf'),
+                   'mean_position_error': np.mean(position_errors),
+                   'final_position_error': position_errors[-1],
+                   'mean_heading_error': np.mean(heading_errors),
+                   'final_heading_error': heading_errors[-1],
+                   'final_particles': len(core.particle_cloud)})
+    return result
+
+
+def parallel_scaling(field, n_particles, workers, backend='thread', n_beams=36, repeats=5, random_state=None,
+                     models=('likelihood_field', 'coarse_to_fine', 'beam')):
+    """ Time the laser likelihood of n_particles particles spread over the free space of a map, on a
+        single core and with the parallel backend for each number of workers, for each sensor model
+        models: the sensor models to time.  The likelihood field and beam models are wrapped in a
+                ParallelLikelihoodModel, and the coarse to fine model is given the workers itself (on threads,
+                whatever the backend), since it ranks all of the particles together.
+        returns: a list of (model, workers, backend, seconds per evaluation, speedup, whether the weights match
+                 the single core weights exactly) tuples, with the single core run of each model first """
+    random_state = np.random.RandomState(random_state)
+    info = field.map.info
+    rows, cols = np.nonzero(np.asarray(field.map.data).reshape((info.height, info.width)) == 0)
+    cells = random_state.randint(len(rows), size=n_particles)
+    x = info.origin.position.x + (cols[cells] + random_state.random_sample(n_particles))*info.resolution
+    y = info.origin.position.y + (rows[cells] + random_state.random_sample(n_particles))*info.resolution
+    theta = random_state.uniform(-math.pi, math.pi, n_particles)
+    ranges = random_state.uniform(0.2, 4.0, n_beams)
+    angles = np.arange(n_beams)*2*math.pi/n_beams
+
+    def time_model(model):
+        model.weights(x, y, theta, ranges, angles)     # warm up
+        start = time.time()
+        for _ in range(repeats):
+            weights = model.weights(x, y, theta, ranges, angles)
+        return (time.time() - start)/repeats, weights
+
+    results = []
+    for name in models:
+        if name == 'likelihood_field':
+            single = LikelihoodFieldModel(field)
+        elif name == 'coarse_to_fine':
+            pyramid = DistanceFieldPyramid(field)
+            single = CoarseToFineModel(LikelihoodFieldModel(field), pyramid)
+        elif name == 'beam':
+            single = BeamRangeModel(RangeTable(field))
+        else:
+            raise ValueError("unknown sensor model %r" % name)
+        single_time, expected = time_model(single)
+        results.append((name, 1, 'single', single_time, 1.0, True))
+        for n_workers in workers:
+            if n_workers <= 1:
+                continue
+            if name == 'coarse_to_fine':
+                model = CoarseToFineModel(LikelihoodFieldModel(field), pyramid, workers=n_workers)
+                model_backend = 'thread'
+            else:
+                model = ParallelLikelihoodModel(single, workers=n_workers, backend=backend)
+                model_backend = backend
+            try:
+                parallel_time, weights = time_model(model)
+            finally:
+                model.close()
+            results.append((name, n_workers, model_backend, parallel_time, single_time/parallel_time,
+                            bool(np.array_equal(weights, expected))))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--maps', nargs='+', default=sorted(glob.glob(os.path.join(MAPS_DIR, '*.yaml'))),
+                        help="the map .yaml files to benchmark on (default: every map in maps/)")
+    parser.add_argument('--particles', nargs='+', type=int, default=[500, 1000, 5000, 10000, 50000],
+                        help="the particle counts to benchmark")
+    parser.add_argument('--steps', type=int, default=50, help="the length of each synthetic sequence")
+    parser.add_argument('--beam-stride', type=int, default=10, help="use every n-th beam of each scan")
+    parser.add_argument('--kld', action='store_true', help="let KLD-sampling adapt the particle count")
+    parser.add_argument('--resample-threshold', type=float, default=0.5,
+                        help="resample when N_eff falls below this fraction of the particle count")
+    parser.add_argument('--global-init', action='store_true',
+                        help="start with the particles spread over the whole map (global localization)")
+    parser.add_argument('--kidnap', type=int, metavar='STEP',
+                        help="move the particles to a random spot of the map at this step (kidnapped robot)")
+    parser.add_argument('--recovery-alpha-slow', type=float, default=0.001,
+                        help="the decay rate of the long term likelihood average (0 disables random particle injection)")
+    parser.add_argument('--coarse-to-fine', action='store_true',
+                        help="score the particles coarse to fine on a pyramid of downsampled distance fields")
+    parser.add_argument('--beam-model', action='store_true',
+                        help="score the particles with the beam model on a precomputed table of expected ranges")
+    parser.add_argument('--seed', type=int, default=0, help="the random seed for the sequences and the filter")
+    parser.add_argument('--sequence', help="replay this .npz sequence instead of generating one (needs one map)")
+    parser.add_argument('--save-sequence', help="save the generated sequence to this .npz file (needs one map)")
+    parser.add_argument('--no-crop', action='store_true',
+                        help="keep the unknown margins of the maps instead of cropping them to the known cells")
+    parser.add_argument('--cache-dir', default=None, help="cache occupancy fields in this directory")
+    parser.add_argument('--workers', nargs='+', type=int,
+                        help="also measure how the parallel likelihood scales with these numbers of workers")
+    parser.add_argument('--backend', default='thread', choices=('thread', 'process'),
+                        help="the pool the parallel likelihood uses")
+    args = parser.parse_args()
+
+    header = "%-12s %9s %9s %9s %9s %9s %10s %9s %9s %9s" % (
+        'map', 'particles', 'odom ms', 'laser ms', 'pose ms', 'resmp ms', 'scans/sec', 'pos err', 'final', 'hdg err')
+    print(header)
+    print('-'*len(header))
+    for map_path in args.maps:
+        start = time.time()
+        field = OccupancyField(load_map(map_path, crop=not args.no_crop), cache_dir=args.cache_dir)
+        range_table = RangeTable(field) if args.beam_model else None
+        load_time = time.time() - start
+
+        if args.sequence:
+            sequence = load_sequence(args.sequence)
+        else:
+            sequence = synthetic_sequence(field, args.steps, random_state=args.seed)
+        if args.save_sequence:
+            save_sequence(args.save_sequence, sequence)
+
+        name = os.path.splitext(os.path.basename(map_path))[0]
+        for n_particles in args.particles:
+            result = run_filter(field, sequence, n_particles, beam_stride=args.beam_stride, kld_sampling=args.kld,
+                                resample_threshold=args.resample_threshold, global_init=args.global_init,
+                                kidnap_step=args.kidnap, recovery_alpha_slow=args.recovery_alpha_slow,
+                                coarse_to_fine=args.coarse_to_fine, range_table=range_table,
+                                random_state=args.seed)
+            print("%-12s %9d %9.2f %9.2f %9.2f %9.2f %10.1f %9.3f %9.3f %9.3f" % (
+                name, n_particles, 1000*result['odom'], 1000*result['laser'], 1000*result['pose'],
+                1000*result['resample'], result['scans_per_sec'], result['mean_position_error'],
+                result['final_position_error'], result['mean_heading_error']))
+        print("%-12s map loaded in %.2f s" % (name, load_time))
+
+        if args.workers:
+            for n_particles in args.particles:
+                for model, n_workers, backend, seconds, speedup, matches in parallel_scaling(
+                        field, n_particles, args.workers, backend=args.backend, random_state=args.seed):
+                    print("%-12s %-16s %9d particles, %2d %-6s workers: %8.2f ms per likelihood, %5.2fx speedup%s" % (
+                        name, model, n_particles, n_workers, backend, 1000*seconds, speedup,
+                        "" if matches else " (WEIGHTS DIFFER FROM SINGLE CORE)"))
+
+
+if __name__ == '__main__':
+    main()
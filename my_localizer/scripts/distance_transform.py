@@ -0,0 +1,75 @@
+""" An exact Euclidean distance transform of a 2-D occupancy grid.
+
+    This follows the two phase algorithm of Meijster, Roerdink and Hesselink (2000), "A general
+    algorithm for computing distance transforms in linear time".  The first phase computes the
+    distance to the closest obstacle within each column, and the second phase combines the columns
+    by computing the lower envelope of parabolas along each row.  Both phases are vectorized so
+    that the Python loops run once per row (phase 1) or once per column (phase 2) instead of once
+    per cell.  All of the arithmetic is done on integers, so the result is exact. """
+
+import numpy as np
+
+
+def squared_distance_transform(occupied):
+    """ Compute the squared Euclidean distance (in cells) from every cell to the closest occupied cell
+        occupied: a 2-D boolean array indexed as occupied[row, column]
+        returns: an int64 array of the same shape.  If there are no occupied cells every entry is
+                 larger than (rows + columns)**2 """
+    occupied = np.asarray(occupied, dtype=bool)
+    n_rows, n_cols = occupied.shape
+    infinity = n_rows + n_cols      # larger than any distance that can occur inside the grid
+
+    # phase 1: distance to the closest obstacle in the same column, scanning down and then up
+    g = np.empty((n_rows, n_cols), dtype=np.int64)
+    g[0] = np.where(occupied[0], 0, infinity)
+    for row in range(1, n_rows):
+        g[row] = np.where(occupied[row], 0, g[row-1] + 1)
+    for row in range(n_rows-2, -1, -1):
+        np.minimum(g[row], g[row+1] + 1, out=g[row])
+
+    # phase 2: lower envelope of the parabolas (x - i)**2 + g(i)**2 along every row at once
+    g2 = np.square(g)
+    rows = np.arange(n_rows)
+    s = np.zeros((n_rows, n_cols), dtype=np.int64)     # the column of each parabola in the envelope
+    t = np.zeros((n_rows, n_cols), dtype=np.int64)     # the column where each parabola starts to win
+    q = np.zeros(n_rows, dtype=np.int64)               # index of the last parabola in each envelope
+    for u in range(1, n_cols):
+        # pop the parabolas that the new one beats at the start of their interval
+        while True:
+            qc = np.maximum(q, 0)
+            s_q = s[rows, qc]
+            t_q = t[rows, qc]
+            beaten = (q >= 0) & (np.square(t_q - s_q) + g2[rows, s_q] > np.square(t_q - u) + g2[:, u])
+            if not beaten.any():
+                break
+            q[beaten] -= 1
+
+        emptied = q < 0
+        q[emptied] = 0
+        s[emptied, 0] = u
+
+        # for the other rows, find where the new parabola overtakes the last one in the envelope
+        s_q = s[rows, q]
+        sep = 1 + (u*u - np.square(s_q) + g2[:, u] - g2[rows, s_q]) // np.maximum(2*(u - s_q), 1)
+        push = ~emptied & (sep < n_cols)
+        q[push] += 1
+        s[rows[push], q[push]] = u
+        t[rows[push], q[push]] = sep[push]
+
+    # read the distances off the envelope, scanning from right to left
+    squared = np.empty((n_rows, n_cols), dtype=np.int64)
+    for u in range(n_cols-1, -1, -1):
+        s_q = s[rows, q]
+        squared[:, u] = np.square(u - s_q) + g2[rows, s_q]
+        q[u == t[rows, q]] -= 1
+    return squared
+
+
+def distance_transform(occupied):
+    """ Compute the Euclidean distance (in cells) from every cell to the closest occupied cell
+        occupied: a 2-D boolean array indexed as occupied[row, column]
+        returns: a float64 array of the same shape, which is inf everywhere if there are no occupied cells """
+    occupied = np.asarray(occupied, dtype=bool)
+    if not occupied.any():
+        return np.full(occupied.shape, np.inf)
+    return np.sqrt(squared_distance_transform(occupied))
@@ -0,0 +1,68 @@
+""" A persistent on-disk cache for arrays that are precomputed from a map (such as the distance
+    field of an OccupancyField).  Cached arrays are stored as .npy files and memory-mapped
+    read-only when they are loaded, so later launches skip the computation entirely and every
+    node on the same host shares the same pages of the file. """
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+# bump this whenever the way any cached array is computed changes, so that stale caches are ignored
+CACHE_VERSION = 1
+
+
+def map_key(grid, info):
+    """ Compute a key that identifies a map by its contents
+        grid: the map data as a numpy array
+        info: the map metadata (nav_msgs/MapMetaData) with the resolution and origin of the map
+        returns: a hex digest of the map data, shape, resolution and origin """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(grid).tobytes())
+    origin = info.origin
+    digest.update(repr((CACHE_VERSION,
+                        grid.shape,
+                        float(info.resolution),
+                        float(origin.position.x), float(origin.position.y), float(origin.position.z),
+                        float(origin.orientation.x), float(origin.orientation.y),
+                        float(origin.orientation.z), float(origin.orientation.w))).encode('ascii'))
+    return digest.hexdigest()
+
+
+def load_cached_array(cache_dir, name, key, compute):
+    """ Load an array from the cache, computing and storing it first if it is not there yet
+        cache_dir: the directory holding the cache files.  If it is None or empty the cache is
+                   bypassed and the array is just computed.
+        name: the kind of array being cached (used as a file name prefix)
+        key: the key identifying the map the array was computed from (see map_key)
+        compute: a function of no arguments that computes the array
+        returns: a read-only numpy memmap of the cached array, or the freshly computed array if the
+                 cache directory cannot be used """
+    if not cache_dir:
+        return compute()
+
+    path = os.path.join(cache_dir, "%s_%s.npy" % (name, key))
+    if os.path.exists(path):
+        try:
+            return np.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            pass    # a corrupt or truncated file is recomputed below
+
+    array = compute()
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary file first and then rename it, so that a node that starts at the same
+        # time never memory-maps a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except (IOError, OSError):
+        return array    # the cache is an optimization, so an unwritable directory is not an error
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,69 @@
+""" A pyramid of downsampled distance fields for coarse-to-fine scoring.  Each coarse cell holds the
+    smallest distance of the full resolution cells it covers, so a lookup in a coarse level never
+    overestimates the distance to the closest obstacle.  Scores computed on a coarse level are
+    therefore optimistic bounds on the full resolution scores, and since the coarse grids are small
+    enough to stay in the cache, many hypotheses can be ranked on them cheaply. """
+
+import numpy as np
+
+from occupancy_field import grid_lookup
+
+
+def min_pool(grid, factor):
+    """ Downsample a grid by taking the minimum of every factor x factor block.  Blocks that stick out
+        over the edge of the grid are taken over the cells that are inside it. """
+    height, width = grid.shape
+    padded_height = -(-height//factor)*factor
+    padded_width = -(-width//factor)*factor
+    padded = np.full((padded_height, padded_width), np.inf, dtype=grid.dtype)
+    padded[:height, :width] = grid
+    return padded.reshape((padded_height//factor, factor, padded_width//factor, factor)).min(axis=3).min(axis=1)
+
+
+class FieldLevel(object):
+    """ One level of a DistanceFieldPyramid
+        Attributes:
+            factor: how many full resolution cells wide each cell of this level is
+            resolution: the width of each cell in meters
+            origin_x, origin_y: the corner of the map, which is the corner of cell [0, 0] of every level
+            closest_occ: the (height, width) grid of lower bounds on the distance to the closest obstacle
+    """
+
+    def __init__(self, factor, resolution, origin_x, origin_y, closest_occ):
+        self.factor = factor
+        self.resolution = resolution
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.closest_occ = closest_occ
+
+    def get_closest_obstacle_distance(self, x, y):
+        """ A lower bound on the distance to the closest obstacle from each point, nan outside of the map """
+        return grid_lookup(self.closest_occ, self.origin_x, self.origin_y, self.resolution, x, y)
+
+
+class DistanceFieldPyramid(object):
+    """ Downsampled copies of an OccupancyField's distance grid
+        Attributes:
+            occupancy_field: the full resolution field
+            levels: the FieldLevels from the finest (the field itself, factor 1) to the coarsest
+    """
+
+    def __init__(self, occupancy_field, factors=(4, 16)):
+        """ factors: the downsampling factor of each coarse level relative to the full resolution field.
+                     With a 0.02 m map the default gives levels of 0.02, 0.08 and 0.32 m. """
+        self.occupancy_field = occupancy_field
+        info = occupancy_field.map.info
+        origin_x, origin_y = info.origin.position.x, info.origin.position.y
+        self.levels = [FieldLevel(1, info.resolution, origin_x, origin_y, occupancy_field.closest_occ)]
+        for factor in sorted(factors):
+            # each level is pooled from the previous one when the factors divide each other, which is cheaper
+            previous = self.levels[-1]
+            if factor % previous.factor == 0:
+                grid = min_pool(previous.closest_occ, factor//previous.factor)
+            else:
+                grid = min_pool(self.levels[0].closest_occ, factor)
+            self.levels.append(FieldLevel(factor, info.resolution*factor, origin_x, origin_y, grid))
+
+    def coarse_levels(self):
+        """ The levels coarser than the full resolution field, coarsest first """
+        return self.levels[:0:-1]
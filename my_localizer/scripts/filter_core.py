@@ -0,0 +1,241 @@
+""" The core of the particle filter, independent of ROS.  The ROS node (pf.py) feeds it odometry
+    poses and laser scans from the live ROS graph, and the benchmark (benchmark_pf.py) feeds it
+    map files and synthetic or recorded sequences, so the filter can be exercised without roscore. """
+
+import math
+
+import numpy as np
+
+from particle_set import ParticleSet
+from sensor_model import LikelihoodFieldModel
+from beam_selection import BeamSelector
+from motion_model import OdometryMotionModel
+from pose_estimation import ClusterPoseEstimator
+from resampling import systematic_resample, get_random_state, effective_sample_size, weight_entropy
+from kld_sampling import kld_resample
+
+
+class ParticleFilterCore(object):
+    """ The particle filter algorithm: initialization, the odometry and laser updates, pose estimation
+        and resampling, all operating on a ParticleSet
+        Attributes:
+            occupancy_field: the OccupancyField of the map we are localizing ourselves in
+            particle_cloud: a ParticleSet representing a probability distribution over robot poses
+            robot_xy_theta: the current estimate of the robot's pose as a (x, y, theta) triple
+            pose_estimate: the current PoseEstimate, which also holds the covariance of the estimate
+            n_particles: the number of particles in the filter (the initial number when KLD sampling is enabled)
+            motion_model: the odometry motion model used to move the particles
+            sensor_model: the laser measurement model used to weight the particles
+            beam_selector: chooses which beams of each scan are used to weight the particles
+            pose_estimator: estimates the robot's pose from the particles (by default, the mean of the heaviest
+                            cluster of particles)
+            resampler: the function used to pick the surviving particles (see resampling.RESAMPLERS)
+            random_state: the source of random numbers for the motion model and resampling
+            resample_threshold: resample only when the effective sample size falls below this fraction of
+                                the number of particles (above 1.0 resamples on every update)
+            kld_sampling: if True, the number of particles is adapted at every resample with KLD-sampling
+            min_particles: the fewest particles KLD-sampling may shrink the filter to
+            max_particles: the most particles KLD-sampling may grow the filter to
+            kld_epsilon: the bound on the KL divergence between the particles and the true posterior
+            kld_bin_size: the (x, y, theta) bin widths of the histogram KLD-sampling counts occupied bins in
+            recovery_alpha_slow, recovery_alpha_fast: the decay rates of the long and short term averages of
+                          the measurement likelihood (augmented MCL).  When the short term average falls below
+                          the long term one, resampling replaces a fraction 1 - w_fast/w_slow of the particles
+                          with random ones over the free space of the map.  An alpha_slow of 0 disables this.
+            w_slow, w_fast: the long and short term averages of the measurement likelihood
+            weights_collapsed: True when the last scan gave every particle a weight of zero, which forces
+                               the next resample.  With recovery enabled that resample spreads the particles
+                               over the free space of the whole map (see resample_particles).
+            filter_stats: the effective sample size, weight entropy, whether a resample happened and how
+                          many random particles were injected on the last update
+    """
+
+    def __init__(self, occupancy_field, n_particles=500, motion_model=None, sensor_model=None,
+                 beam_selector=None, pose_estimator=None, resampler=systematic_resample, random_state=None, resample_threshold=0.5,
+                 kld_sampling=True, min_particles=100, max_particles=5000, kld_epsilon=0.05,
+                 kld_bin_size=(0.5, 0.5, math.radians(10)), recovery_alpha_slow=0.001, recovery_alpha_fast=0.1):
+        self.occupancy_field = occupancy_field
+        self.n_particles = n_particles
+        self.motion_model = motion_model or OdometryMotionModel()
+        self.sensor_model = sensor_model or LikelihoodFieldModel(occupancy_field)
+        self.beam_selector = beam_selector or BeamSelector(stride=10)
+        self.pose_estimator = pose_estimator or ClusterPoseEstimator()
+        self.resampler = resampler
+        self.random_state = get_random_state(random_state)
+        self.resample_threshold = resample_threshold
+        self.kld_sampling = kld_sampling
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+        self.kld_epsilon = kld_epsilon
+        self.kld_bin_size = kld_bin_size
+        self.recovery_alpha_slow = recovery_alpha_slow
+        self.recovery_alpha_fast = recovery_alpha_fast
+
+        self.w_slow = 0.0
+        self.w_fast = 0.0
+        self.weights_collapsed = False
+        self.particle_cloud = ParticleSet()
+        self.robot_xy_theta = None
+        self.pose_estimate = None
+        self.filter_stats = {}
+
+    def initialize_particle_cloud(self, xy_theta, lin_noise=1.0, ang_noise=math.pi/2.0):
+        """ Initialize the particle cloud around a pose
+            xy_theta: a triple consisting of the mean x, y, and theta (yaw) to initialize the particle cloud around
+            lin_noise, ang_noise: the widths of the uniform noise added to the position and heading """
+        self.particle_cloud = ParticleSet.around_pose(xy_theta, self.n_particles, lin_noise, ang_noise,
+                                                       self.random_state)
+        self.reset_likelihood_averages()
+
+        # normalize particles because all weights were originally set to 1 on default
+        self.normalize_particles()
+        return self.update_robot_pose()
+
+    def initialize_particle_cloud_globally(self, n_particles=None):
+        """ Initialize the particle cloud uniformly over the free space of the map, for when the robot's
+            pose is unknown (or it has been kidnapped)
+            n_particles: the number of particles.  By default this is max_particles when KLD-sampling is
+                         enabled (it will shrink the cloud once the particles converge), and n_particles otherwise """
+        if n_particles is None:
+            n_particles = self.max_particles if self.kld_sampling else self.n_particles
+        self.particle_cloud = ParticleSet.in_free_space(self.occupancy_field, n_particles, self.random_state)
+        self.reset_likelihood_averages()
+        self.normalize_particles()
+        return self.update_robot_pose()
+
+    def normalize_particles(self):
+        """ Make sure the particle weights define a valid distribution (i.e. sum to 1.0) """
+        return self.particle_cloud.normalize()
+
+    def reset_likelihood_averages(self):
+        """ Forget the averages of the measurement likelihood, e.g. after the particles have been replaced """
+        self.w_slow = 0.0
+        self.w_fast = 0.0
+
+    def update_likelihood_averages(self, w_avg):
+        """ Fold the average measurement likelihood of a scan into the long and short term averages """
+        if self.recovery_alpha_slow > 0:
+            self.w_slow += self.recovery_alpha_slow*(w_avg - self.w_slow)
+            self.w_fast += self.recovery_alpha_fast*(w_avg - self.w_fast)
+
+    def injection_probability(self):
+        """ The fraction of the particles to replace with random ones at the next resample, max(0, 1 - w_fast/w_slow) """
+        if self.recovery_alpha_slow <= 0 or self.w_slow <= 0:
+            return 0.0
+        return max(0.0, 1.0 - self.w_fast/self.w_slow)
+
+    def update_robot_pose(self):
+        """ Update the estimate of the robot's pose given the updated particles
+            returns: the estimate as a (x, y, theta) triple """
+        # first make sure that the particle weights are normalized
+        self.normalize_particles()
+        self.pose_estimate = self.pose_estimator.estimate(self.particle_cloud)
+        self.robot_xy_theta = self.pose_estimate.xy_theta
+        return self.robot_xy_theta
+
+    def update_particles_with_odom(self, old_odom_xy_theta, new_odom_xy_theta):
+        """ Move every particle by a noisy version of the motion between two odometry poses """
+        self.motion_model.sample(self.particle_cloud, old_odom_xy_theta, new_odom_xy_theta, self.random_state)
+
+    def update_particles_with_laser(self, scan):
+        """ Update the particle weights in response to a scan
+            scan: a sensor_msgs/LaserScan (or anything with the same ranges, angle_min, angle_increment,
+                  range_min and range_max fields) """
+        ranges, angles = self.beam_selector.select(scan)
+        if not len(ranges):
+            return
+
+        # score every beam of every particle at once
+        particles = self.particle_cloud
+        self.apply_likelihoods(self.sensor_model.weights(particles.x, particles.y, particles.theta, ranges, angles))
+
+    def apply_likelihoods(self, likelihoods):
+        """ Fold the likelihood of a scan for every particle into the particle weights.  This is the second half
+            of update_particles_with_laser, for when the particles were scored elsewhere (e.g. together with the
+            particles of other robots, see multi_robot.py).
+            likelihoods: the (unnormalized) weight the scan gives each particle (see LikelihoodFieldModel.weights) """
+        particles = self.particle_cloud
+
+        # the likelihood of the scan under the current distribution of the particles, for augmented MCL
+        total = np.sum(particles.w)
+        if total > 0:
+            self.update_likelihood_averages(np.dot(particles.w, likelihoods)/total)
+
+        # since the particles are not resampled on every update, the new likelihoods are combined with the
+        # weights that were carried over from the last update
+        particles.w *= likelihoods
+        if not self.normalize_particles():
+            # the scan ruled out every particle (e.g. they have all left the map).  There is nothing to
+            # learn from the weights, so they are made uniform and the next resample starts the filter over
+            self.weights_collapsed = True
+
+    def resample_particles(self):
+        """ Resample the particles according to the particle weights.  After resampling every particle has
+            the same weight, and some of them may have been replaced by random ones (see inject_random_particles).
+            returns: the number of random particles that were injected """
+        if self.weights_collapsed and self.recovery_alpha_slow > 0:
+            # every particle was ruled out, so the robot is lost.  w_slow and w_fast can't help here: after a
+            # reset they stay at 0 as long as every scan rules out every particle, which would never inject
+            # anything.  The particles are spread over the whole map instead.
+            self.initialize_particle_cloud_globally()
+            return len(self.particle_cloud)
+
+        # make sure the distribution is normalized
+        self.normalize_particles()
+
+        particles = self.particle_cloud
+        if self.kld_sampling:
+            # KLD-sampling also decides how many particles the new cloud should have
+            inds = kld_resample(particles.x, particles.y, particles.theta, particles.w,
+                                self.min_particles, self.max_particles, bin_size=self.kld_bin_size,
+                                epsilon=self.kld_epsilon, resampler=self.resampler, random_state=self.random_state)
+        else:
+            inds = self.resampler(particles.w, len(particles), self.random_state)
+        self.particle_cloud = particles.gather(inds)
+        self.particle_cloud.w.fill(1.0/len(inds))
+        return self.inject_random_particles()
+
+    def inject_random_particles(self):
+        """ Replace a random subset of the particles with particles drawn uniformly over the free space of the
+            map, each with probability injection_probability() (augmented MCL)
+            returns: the number of particles that were replaced """
+        probability = self.injection_probability()
+        if probability <= 0:
+            return 0
+        particles = self.particle_cloud
+        n_random = self.random_state.binomial(len(particles), min(probability, 1.0))
+        if n_random:
+            slots = self.random_state.permutation(len(particles))[:n_random]
+            random_particles = ParticleSet.in_free_space(self.occupancy_field, n_random, self.random_state)
+            particles.x[slots] = random_particles.x
+            particles.y[slots] = random_particles.y
+            particles.theta[slots] = random_particles.theta
+            # start the averages over, so the filter is given time to converge on the new particles
+            self.reset_likelihood_averages()
+        return n_random
+
+    def resample_if_degenerate(self):
+        """ Resample the particles only when their weights have degenerated, that is when the effective sample
+            size N_eff = 1/sum(w**2) has fallen below resample_threshold times the number of particles.
+            returns: filter_stats, the statistics of the weights before resampling """
+        n_eff = effective_sample_size(self.particle_cloud.w)
+        entropy = weight_entropy(self.particle_cloud.w)
+        resampled = self.weights_collapsed or n_eff < self.resample_threshold*len(self.particle_cloud)
+        injected = 0
+        if resampled:
+            injected = self.resample_particles()
+        self.weights_collapsed = False
+
+        self.filter_stats = {'n_eff': n_eff, 'weight_entropy': entropy, 'resampled': resampled,
+                             'injected': injected, 'w_slow': self.w_slow, 'w_fast': self.w_fast}
+        return self.filter_stats
+
+    def update(self, old_odom_xy_theta, new_odom_xy_theta, scan):
+        """ Run one full filter update: move the particles by the odometry, weight them with the scan,
+            estimate the robot's pose and resample if needed
+            returns: the new estimate of the robot's pose as a (x, y, theta) triple """
+        self.update_particles_with_odom(old_odom_xy_theta, new_odom_xy_theta)
+        self.update_particles_with_laser(scan)
+        self.update_robot_pose()
+        self.resample_if_degenerate()
+        return self.robot_xy_theta
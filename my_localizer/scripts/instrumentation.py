@@ -0,0 +1,144 @@
+""" Hot path instrumentation for the particle filter: wall-clock latency histograms for each stage
+    of an update, counters of received, processed, skipped and dropped scans, and the lag between a
+    scan's timestamp and the time it is processed.  When instrumentation is disabled, timing a stage
+    goes through a shared no-op context manager, and an in-process profiler hook is only called when
+    one is installed. """
+
+import bisect
+import time
+
+# histogram bucket edges in seconds, logarithmically spaced from 0.1 ms to 10 s
+BUCKET_EDGES = [10**(-4 + 0.2*i) for i in range(26)]
+
+
+class LatencyHistogram(object):
+    """ A fixed-bucket histogram of durations
+        Attributes:
+            counts: the number of samples in each bucket (the last bucket holds everything above 10 s)
+            count: the total number of samples
+            total: the sum of all of the samples in seconds
+            max: the largest sample in seconds
+    """
+
+    def __init__(self):
+        self.counts = [0]*(len(BUCKET_EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """ Add a sample to the histogram """
+        self.counts[bisect.bisect_left(BUCKET_EDGES, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        return self.total/self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """ An upper bound on the given percentile (as a fraction, e.g. 0.95), taken from the bucket edges """
+        if not self.count:
+            return 0.0
+        target = fraction*self.count
+        seen = 0
+        for edge, count in zip(BUCKET_EDGES, self.counts):
+            seen += count
+            if seen >= target:
+                return min(edge, self.max)
+        return self.max
+
+
+class _StageTimer(object):
+    """ Times one run of a stage and records it when the with block exits """
+    __slots__ = ('instrumentation', 'stage', 'start')
+
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.record(self.stage, time.time() - self.start)
+        return False
+
+
+class _NullTimer(object):
+    """ Stands in for a _StageTimer when instrumentation is disabled """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class FilterInstrumentation(object):
+    """ Collects the timings and counters of the filter's hot path
+        Attributes:
+            enabled: if False, stage() and record_lag() do nothing
+            profiler_hook: an optional function called as profiler_hook(stage, seconds) after every timed stage
+            stages: a dict from stage name to its LatencyHistogram
+            queue_lag: a LatencyHistogram of the time between a scan's timestamp and when it was taken off the
+                       queue, including the scans that are then dropped for being too old
+            counters: a dict of event counts (scans received, processed, skipped for each reason, dropped, ...)
+    """
+
+    def __init__(self, enabled=True, profiler_hook=None):
+        self.enabled = enabled
+        self.profiler_hook = profiler_hook
+        self.stages = {}
+        self.queue_lag = LatencyHistogram()
+        self.counters = {}
+
+    def stage(self, name):
+        """ Time a stage of the filter update, as in:
+                with instrumentation.stage('laser'):
+                    ...
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, name)
+
+    def record(self, name, seconds):
+        """ Record a duration for a stage """
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = LatencyHistogram()
+        histogram.record(seconds)
+        if self.profiler_hook is not None:
+            self.profiler_hook(name, seconds)
+
+    def record_lag(self, seconds):
+        """ Record the lag between a scan's timestamp and the time it was taken off the queue """
+        if self.enabled:
+            self.queue_lag.record(max(seconds, 0.0))
+
+    def count(self, event, n=1):
+        """ Increment the counter of an event (counters are kept even when timing is disabled) """
+        self.counters[event] = self.counters.get(event, 0) + n
+
+    def summary(self):
+        """ Summarize everything collected so far
+            returns: a list of (key, value) pairs, with times in milliseconds """
+        values = []
+        for name in sorted(self.stages):
+            histogram = self.stages[name]
+            values.extend([("%s count" % name, histogram.count),
+                           ("%s mean ms" % name, 1000*histogram.mean()),
+                           ("%s p50 ms" % name, 1000*histogram.percentile(0.5)),
+                           ("%s p95 ms" % name, 1000*histogram.percentile(0.95)),
+                           ("%s max ms" % name, 1000*histogram.max)])
+        if self.queue_lag.count:
+            values.extend([("queue lag p50 ms", 1000*self.queue_lag.percentile(0.5)),
+                           ("queue lag p95 ms", 1000*self.queue_lag.percentile(0.95)),
+                           ("queue lag max ms", 1000*self.queue_lag.max)])
+        values.extend(sorted(self.counters.items()))
+        return values
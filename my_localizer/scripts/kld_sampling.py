@@ -0,0 +1,65 @@
+""" KLD-sampling (Fox, 2003): adapt the number of particles at each resample to how spread out the
+    particles are.  The particles are binned in a histogram over (x, y, theta), and enough particles
+    are kept that, with probability 1 - delta, the KL divergence between the sampled distribution and
+    the true posterior stays below epsilon.  A converged filter occupies few bins and shrinks towards
+    min_particles, and a filter that is still searching grows towards max_particles. """
+
+import math
+
+import numpy as np
+
+from resampling import systematic_resample, get_random_state
+
+
+def kld_sample_size(k, epsilon=0.05, z=2.326):
+    """ The number of particles needed when the particles occupy k histogram bins
+        k: the number of occupied bins (scalar or array)
+        epsilon: the bound on the KL divergence
+        z: the upper 1 - delta quantile of the standard normal distribution (2.326 for delta = 0.01)
+        returns: the required number of particles (float, or an array of floats for array k) """
+    k_minus_1 = np.maximum(np.asarray(k, dtype=np.float64) - 1.0, 1.0)
+    a = 2.0/(9.0*k_minus_1)
+    n = k_minus_1/(2.0*epsilon)*np.power(1.0 - a + np.sqrt(a)*z, 3)
+    return np.where(np.asarray(k) > 1, n, 1.0)
+
+
+def histogram_bins(x, y, theta, bin_size):
+    """ Compute a single integer key for the (x, y, theta) histogram bin of each particle
+        bin_size: a triple of the bin widths in x, y (meters) and theta (radians) """
+    bin_x = np.floor(np.asarray(x)/bin_size[0]).astype(np.int64)
+    bin_y = np.floor(np.asarray(y)/bin_size[1]).astype(np.int64)
+    bin_theta = np.floor(np.mod(theta, 2*math.pi)/bin_size[2]).astype(np.int64)
+    # x and y bins fit comfortably in 24 bits each for any realistic map, and theta bins in 16
+    return ((bin_x & 0xFFFFFF) << 40) | ((bin_y & 0xFFFFFF) << 16) | (bin_theta & 0xFFFF)
+
+
+def kld_resample(x, y, theta, weights, min_particles, max_particles, bin_size=(0.5, 0.5, math.radians(10)),
+                 epsilon=0.05, z=2.326, resampler=systematic_resample, random_state=None):
+    """ Resample the particles, choosing how many to keep with KLD-sampling
+        x, y, theta: arrays of the particle poses
+        weights: the normalized particle weights
+        min_particles, max_particles: the bounds on the number of particles to return
+        bin_size: the widths of the (x, y, theta) histogram bins
+        epsilon, z: the KL divergence bound and normal quantile (see kld_sample_size)
+        resampler: the resampler used to draw the candidate particles (see resampling.RESAMPLERS)
+        returns: an array of between min_particles and max_particles particle indices
+
+        max_particles candidates are drawn at once and visited in a random order, which is equivalent to
+        drawing them one by one.  The result is the shortest prefix whose length reaches the sample size
+        required by the number of bins that the prefix occupies. """
+    random_state = get_random_state(random_state)
+    candidates = resampler(weights, max_particles, random_state)
+    candidates = candidates[random_state.permutation(max_particles)]
+
+    # count the number of distinct bins occupied by each prefix of the candidates
+    bins = histogram_bins(np.asarray(x)[candidates], np.asarray(y)[candidates], np.asarray(theta)[candidates],
+                          bin_size)
+    _, first_seen = np.unique(bins, return_index=True)
+    is_new_bin = np.zeros(max_particles, dtype=np.int64)
+    is_new_bin[first_seen] = 1
+    occupied = np.cumsum(is_new_bin)
+
+    required = np.maximum(kld_sample_size(occupied, epsilon, z), min_particles)
+    enough = np.flatnonzero(np.arange(1, max_particles + 1) >= required)
+    n = enough[0] + 1 if len(enough) else max_particles
+    return np.sort(candidates[:n])
@@ -0,0 +1,183 @@
+""" Loads maps straight from the map_server files (a .yaml description and a .pgm image) without
+    going through the static_map service.  The result has the same layout as a nav_msgs/OccupancyGrid,
+    so it can be handed to OccupancyField directly.  The image is memory-mapped and thresholded with a
+    table lookup, so the pixels are never copied into Python objects, and the map is cropped to the
+    part that was actually mapped. """
+
+import os
+
+import numpy as np
+import yaml
+
+
+class Point(object):
+    """ A stand in for geometry_msgs/Point """
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class Quaternion(object):
+    """ A stand in for geometry_msgs/Quaternion """
+    def __init__(self, x=0.0, y=0.0, z=0.0, w=1.0):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.w = w
+
+
+class Pose(object):
+    """ A stand in for geometry_msgs/Pose """
+    def __init__(self, position=None, orientation=None):
+        self.position = position or Point()
+        self.orientation = orientation or Quaternion()
+
+
+class MapMetaData(object):
+    """ A stand in for nav_msgs/MapMetaData """
+    def __init__(self, resolution, width, height, origin):
+        self.resolution = resolution
+        self.width = width
+        self.height = height
+        self.origin = origin
+
+
+class OccupancyGrid(object):
+    """ A stand in for nav_msgs/OccupancyGrid
+        Attributes:
+            info: the MapMetaData of the map
+            data: the occupancy of each cell (100 occupied, 0 free, -1 unknown) as a flat int8 array in row
+                  major order, starting with the cell at the map origin
+    """
+    def __init__(self, info, data):
+        self.info = info
+        self.data = data
+
+
+def read_pnm(path):
+    """ Memory-map a binary PGM (P5) or PPM (P6) image, without reading the pixels into memory
+        returns: a read-only (rows, columns, channels) uint8 memmap of the pixels, with the rows in image
+                 order (top first).  PGMs have 1 channel and PPMs 3. """
+    with open(path, 'rb') as f:
+        # the header is four whitespace separated tokens (magic, width, height, maxval), possibly with
+        # comments, and always fits in the start of the file
+        header = f.read(4096)
+
+    tokens = []
+    pos = 0
+    while len(tokens) < 4:
+        while header[pos:pos+1].isspace():
+            pos += 1
+        if header[pos:pos+1] == b'#':
+            pos = header.index(b'\n', pos)
+            continue
+        end = pos
+        while not header[end:end+1].isspace():
+            end += 1
+        tokens.append(header[pos:end])
+        pos = end
+    pos += 1    # a single whitespace character separates the header from the pixels
+
+    magic, width, height, maxval = tokens[0], int(tokens[1]), int(tokens[2]), int(tokens[3])
+    if magic not in (b'P5', b'P6') or maxval > 255:
+        raise ValueError("%s is not an 8-bit binary PGM or PPM image" % path)
+    channels = 3 if magic == b'P6' else 1
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=pos, shape=(height, width, channels))
+
+
+def occupancy_table(channels, occupied_thresh, free_thresh, negate=False):
+    """ Tabulate the trinary occupancy (100 occupied, 0 free, -1 unknown) of every possible sum of the
+        channels of a pixel, thresholding the average of the channels the way map_server does
+        returns: an int8 array indexed by the sum of the channels of a pixel """
+    levels = np.arange(255*channels + 1)/float(channels)
+    if negate:
+        occupancy = levels/255.0
+    else:
+        occupancy = (255.0 - levels)/255.0
+    table = np.full(levels.shape, -1, dtype=np.int8)
+    table[occupancy > occupied_thresh] = 100
+    table[occupancy < free_thresh] = 0
+    return table
+
+
+def known_bounds(grid):
+    """ Find the bounding box of the known (free or occupied) cells of a grid
+        returns: the (first row, last row + 1, first column, last column + 1) of the box, or None if no cell
+                 is known """
+    known = grid != -1
+    rows = np.flatnonzero(known.any(axis=1))
+    if not len(rows):
+        return None
+    cols = np.flatnonzero(known.any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def crop_to_known(map, margin=0.5):
+    """ Crop a map to the bounding box of its known (free or occupied) cells.  The scans of the ac109 rooms
+        are mostly unknown margin, which every array computed from the map would otherwise pay for.
+        map: the map to crop (a nav_msgs/OccupancyGrid or an OccupancyGrid)
+        margin: how much (in meters) of the unknown space around the known cells to keep.  Beam endpoints
+                that fall outside of the cropped map make a particle impossible, so this leaves room for
+                the endpoints of obstacles just past the edge of what was mapped.
+        returns: an OccupancyGrid, whose origin is moved to the corner of the cropped grid """
+    info = map.info
+    grid = np.asarray(map.data, dtype=np.int8).reshape((info.height, info.width))
+    bounds = known_bounds(grid)
+    if bounds is None:
+        return OccupancyGrid(info, grid.ravel())
+    row_start, row_end, col_start, col_end = bounds
+    margin_cells = int(np.ceil(margin/info.resolution))
+    row_start, col_start = max(row_start - margin_cells, 0), max(col_start - margin_cells, 0)
+    row_end, col_end = min(row_end + margin_cells, info.height), min(col_end + margin_cells, info.width)
+    grid = np.ascontiguousarray(grid[row_start:row_end, col_start:col_end])
+
+    # move the origin to the corner of the cropped grid (in the map frame, which may be rotated)
+    orientation = info.origin.orientation
+    yaw = 2*np.arctan2(orientation.z, orientation.w)
+    dx, dy = col_start*info.resolution, row_start*info.resolution
+    origin = Pose(position=Point(x=info.origin.position.x + dx*np.cos(yaw) - dy*np.sin(yaw),
+                                 y=info.origin.position.y + dx*np.sin(yaw) + dy*np.cos(yaw),
+                                 z=info.origin.position.z),
+                  orientation=Quaternion(x=orientation.x, y=orientation.y, z=orientation.z, w=orientation.w))
+    height, width = grid.shape
+    return OccupancyGrid(MapMetaData(resolution=info.resolution, width=width, height=height, origin=origin),
+                         grid.ravel())
+
+
+def load_map(yaml_path, crop=True, margin=0.5):
+    """ Load a map the way map_server does (in trinary mode)
+        yaml_path: the path of the map's .yaml file
+        crop: if True the map is cropped to the bounding box of its known cells (see crop_to_known)
+        margin: how much (in meters) of the unknown space around the known cells to keep when cropping
+        returns: an OccupancyGrid """
+    with open(yaml_path) as f:
+        description = yaml.safe_load(f)
+
+    # image paths are relative to the yaml file.  If an absolute path does not exist on this machine,
+    # fall back to looking for the image next to the yaml file
+    image_path = description['image']
+    if os.path.isabs(image_path) and not os.path.exists(image_path):
+        image_path = os.path.basename(image_path)
+    image_path = os.path.join(os.path.dirname(os.path.abspath(yaml_path)), image_path)
+
+    # threshold every pixel with a single table lookup, straight from the memory-mapped image.  Images have
+    # the top row first, but occupancy grids start at the origin (the bottom left corner).
+    pixels = read_pnm(image_path)[::-1]
+    channels = pixels.shape[2]
+    table = occupancy_table(channels, description['occupied_thresh'], description['free_thresh'],
+                            description.get('negate', 0))
+    if channels == 1:
+        grid = table[pixels[:, :, 0]]
+    else:
+        grid = table[pixels.sum(axis=2, dtype=np.uint16)]
+
+    origin = description['origin']
+    height, width = grid.shape
+    info = MapMetaData(resolution=float(description['resolution']), width=width, height=height,
+                       origin=Pose(position=Point(x=float(origin[0]), y=float(origin[1])),
+                                   orientation=Quaternion(z=np.sin(origin[2]/2.0), w=np.cos(origin[2]/2.0))))
+    map = OccupancyGrid(info, grid.ravel())
+    if crop:
+        map = crop_to_known(map, margin)
+    return map
@@ -0,0 +1,163 @@
+""" Keeps the occupancy fields of several maps (e.g. the floors or rooms of a building) resident at
+    once, so that the localizer can switch between them at runtime without recomputing anything.
+    Fields are loaded on first use and kept in a least recently used cache under a memory budget:
+    when loading a map pushes the total over the budget, the maps that have gone unused the longest
+    are dropped (their fields stay in the on-disk field cache, so loading them again is cheap).
+
+    When it is not known which map the robot is in, score_maps compares the maps by how well the
+    best poses in each of them explain the current scan. """
+
+import collections
+import math
+
+import numpy as np
+
+from map_io import load_map, crop_to_known
+from occupancy_field import OccupancyField
+from particle_set import ParticleSet
+from sensor_model import LikelihoodFieldModel
+from motion_model import angle_normalize
+
+
+def field_bytes(field):
+    """ The memory held by an OccupancyField: its distance grid, free cell index and map data """
+    return field.closest_occ.nbytes + field.free_cells.nbytes + np.asarray(field.map.data).nbytes
+
+
+class MapScore(object):
+    """ How well a map explains a scan (see MapManager.score_maps)
+        Attributes:
+            name: the name of the map
+            score: the weight of the best pose found in the map (comparable between maps scored with the
+                   same sensor model and scan)
+            xy_theta: the best pose found in the map as a (x, y, theta) triple
+    """
+
+    def __init__(self, name, score, xy_theta):
+        self.name = name
+        self.score = score
+        self.xy_theta = xy_theta
+
+
+class MapManager(object):
+    """ An LRU cache of the occupancy fields of a set of named maps
+        Attributes:
+            sources: a dict from the name of each map to where it comes from, either the path of its .yaml
+                     file or an already loaded OccupancyGrid
+            memory_budget: the most bytes of fields to keep resident.  The most recently used field is always
+                           kept, even if it alone is over the budget.
+            cache_dir: the directory the fields are cached in on disk (see OccupancyField)
+            crop: if True maps are cropped to their known cells when they are loaded (see map_io.crop_to_known)
+            margin: how much (in meters) of the unknown space around the known cells to keep when cropping
+            loads: the number of times a field was loaded (or computed)
+            evictions: the number of times a field was dropped to stay under the memory budget
+    """
+
+    def __init__(self, maps=None, memory_budget=512*2**20, cache_dir=None, crop=True, margin=0.5):
+        """ maps: a dict from map names to .yaml paths or OccupancyGrids """
+        self.sources = dict(maps or {})
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir
+        self.crop = crop
+        self.margin = margin
+        self.loads = 0
+        self.evictions = 0
+        # the resident fields, least recently used first
+        self._fields = collections.OrderedDict()
+        self._bytes = {}
+
+    def add_map(self, name, source):
+        """ Add (or replace) a map, given the path of its .yaml file or an OccupancyGrid """
+        self.sources[name] = source
+        self.discard(name)
+
+    def names(self):
+        return sorted(self.sources)
+
+    def __contains__(self, name):
+        return name in self.sources
+
+    def resident(self):
+        """ The names of the maps whose fields are resident, least recently used first """
+        return list(self._fields)
+
+    def memory_used(self):
+        """ The bytes held by the resident fields """
+        return sum(self._bytes.values())
+
+    def get(self, name):
+        """ Get the OccupancyField of a map, loading it if it is not resident
+            returns: the OccupancyField (raises KeyError for unknown maps) """
+        field = self._fields.pop(name, None)
+        if field is None:
+            field = self._load(name)
+            self._bytes[name] = field_bytes(field)
+            self.loads += 1
+        # reinserting the field makes it the most recently used one
+        self._fields[name] = field
+        self._evict()
+        return field
+
+    def discard(self, name):
+        """ Drop the field of a map if it is resident """
+        self._fields.pop(name, None)
+        self._bytes.pop(name, None)
+
+    def _load(self, name):
+        source = self.sources[name]
+        if hasattr(source, 'info'):
+            map = source
+        else:
+            map = load_map(source, crop=False)
+        if self.crop:
+            map = crop_to_known(map, self.margin)
+        return OccupancyField(map, cache_dir=self.cache_dir)
+
+    def _evict(self):
+        while len(self._fields) > 1 and self.memory_used() > self.memory_budget:
+            name, _ = self._fields.popitem(last=False)
+            del self._bytes[name]
+            self.evictions += 1
+
+    def score_maps(self, ranges, angles, names=None, n_particles=5000, rounds=3, keep_fraction=0.1,
+                   lin_noise=0.2, ang_noise=math.radians(10), random_state=None):
+        """ Rank maps by how well the best poses in each of them explain a scan.  Each map is searched by
+            spreading particles over its free space and then repeatedly resampling the best of them with
+            decreasing noise.
+            ranges, angles: the beams of the scan in the robot's frame (see BeamSelector.select)
+            names: the maps to compare (by default all of them).  Every one of them is loaded in turn,
+                   so with a tight memory budget this evicts the other fields.
+            n_particles: the number of poses tried per map and round
+            rounds: the number of rounds of resampling around the best poses
+            keep_fraction: the fraction of the poses that are resampled around in the next round
+            lin_noise, ang_noise: the standard deviation of the noise of the first round of resampling,
+                                  which is halved every round
+            returns: a list of MapScores, best first """
+        random_state = np.random.RandomState(random_state)
+        scores = []
+        for name in (self.names() if names is None else names):
+            field = self.get(name)
+            sensor_model = LikelihoodFieldModel(field)
+            particles = ParticleSet.in_free_space(field, n_particles, random_state)
+            n_keep = max(1, int(n_particles*keep_fraction))
+            for step in range(rounds + 1):
+                w = sensor_model.weights(particles.x, particles.y, particles.theta, ranges, angles)
+                if step == rounds:
+                    break
+                # keep the best poses as they are, so a round never loses the best pose found so far, and
+                # draw the rest of the next round around them with less noise every round
+                best = np.argpartition(-w, n_keep - 1)[:n_keep]
+                parents = best[random_state.randint(n_keep, size=n_particles - n_keep)]
+                scale = 0.5**step
+                particles = ParticleSet(
+                    np.concatenate((particles.x[best], particles.x[parents] +
+                                    random_state.normal(0, lin_noise*scale, len(parents)))),
+                    np.concatenate((particles.y[best], particles.y[parents] +
+                                    random_state.normal(0, lin_noise*scale, len(parents)))),
+                    np.concatenate((particles.theta[best], angle_normalize(particles.theta[parents] +
+                                    random_state.normal(0, ang_noise*scale, len(parents))))))
+            i = int(np.argmax(w))
+            scores.append(MapScore(name, float(w[i]), (float(particles.x[i]), float(particles.y[i]),
+                                                       float(particles.theta[i]))))
+        scores.sort(key=lambda s: -s.score)
+        return scores
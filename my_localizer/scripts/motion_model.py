@@ -0,0 +1,69 @@
+""" The odometry motion model: moves every particle by the change in the odometry pose, decomposed
+    into a rotation, a translation and a second rotation, with noise added to each of them.  See
+    sample_motion_model_odometry in Probabilistic Robotics (Thrun, Burgard and Fox), chapter 5.4. """
+
+import math
+
+import numpy as np
+
+from resampling import get_random_state
+
+
+def angle_normalize(z):
+    """ Map an angle (or an array of angles) to the range [-pi,pi] """
+    return np.arctan2(np.sin(z), np.cos(z))
+
+
+class OdometryMotionModel(object):
+    """ Samples new particle poses from the rotation-translation-rotation odometry motion model
+        Attributes:
+            alpha1: how much rotational noise is added per unit of rotation
+            alpha2: how much rotational noise is added per unit of translation
+            alpha3: how much translational noise is added per unit of translation
+            alpha4: how much translational noise is added per unit of rotation
+            min_translation: below this translation (in meters) the first rotation is taken to be zero,
+                             since the direction of a very small translation is mostly odometry noise
+    """
+
+    def __init__(self, alpha1=0.2, alpha2=0.2, alpha3=0.2, alpha4=0.2, min_translation=0.01):
+        self.alpha1 = alpha1
+        self.alpha2 = alpha2
+        self.alpha3 = alpha3
+        self.alpha4 = alpha4
+        self.min_translation = min_translation
+
+    def decompose(self, old_xy_theta, new_xy_theta):
+        """ Decompose the motion between two odometry poses into (rot1, trans, rot2)
+            old_xy_theta, new_xy_theta: the odometry poses as (x, y, theta) triples """
+        dx = new_xy_theta[0] - old_xy_theta[0]
+        dy = new_xy_theta[1] - old_xy_theta[1]
+        trans = math.sqrt(dx*dx + dy*dy)
+        if trans < self.min_translation:
+            rot1 = 0.0
+        else:
+            rot1 = float(angle_normalize(math.atan2(dy, dx) - old_xy_theta[2]))
+        rot2 = float(angle_normalize(new_xy_theta[2] - old_xy_theta[2] - rot1))
+        return rot1, trans, rot2
+
+    def sample(self, particles, old_xy_theta, new_xy_theta, random_state=None):
+        """ Move every particle in place by a noisy version of the odometry motion
+            particles: the ParticleSet to update
+            old_xy_theta, new_xy_theta: the odometry poses at the last update and now
+            random_state: the source of random numbers (see resampling.get_random_state) """
+        random_state = get_random_state(random_state)
+        rot1, trans, rot2 = self.decompose(old_xy_theta, new_xy_theta)
+        n = len(particles)
+
+        # the noise is computed once for the whole update, since it only depends on the odometry
+        rot1_std = math.sqrt(self.alpha1*rot1*rot1 + self.alpha2*trans*trans)
+        trans_std = math.sqrt(self.alpha3*trans*trans + self.alpha4*(rot1*rot1 + rot2*rot2))
+        rot2_std = math.sqrt(self.alpha1*rot2*rot2 + self.alpha2*trans*trans)
+
+        rot1_hat = rot1 - random_state.normal(0.0, rot1_std, n) if rot1_std > 0 else np.full(n, rot1)
+        trans_hat = trans - random_state.normal(0.0, trans_std, n) if trans_std > 0 else np.full(n, trans)
+        rot2_hat = rot2 - random_state.normal(0.0, rot2_std, n) if rot2_std > 0 else np.full(n, rot2)
+
+        heading = particles.theta + rot1_hat
+        particles.x += trans_hat*np.cos(heading)
+        particles.y += trans_hat*np.sin(heading)
+        particles.theta = angle_normalize(heading + rot2_hat)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+""" A particle filter node that localizes several robots in the same map.  Instead of running one pf.py
+    per robot, each with its own copy of the occupancy field and its own tf listener, this node hosts a
+    filter for every robot, shares a single occupancy field between all of them, and scores the particles
+    of all of the robots that got a new scan together, once per tick (see multi_robot.py).
+
+    The robots are given by their namespaces in the ~robots parameter.  For a robot "robot1" the node
+    listens to robot1/scan and robot1/initialpose, publishes robot1/particlecloud and robot1/estimated_pose,
+    and broadcasts the transform from the shared map frame to robot1/odom.  The frames of each robot are
+    prefixed with its namespace, as with tf_prefix.  The filters are configured with the same private
+    parameters as pf.py.
+"""
+
+import math
+import threading
+import traceback
+
+import rospy
+
+from std_msgs.msg import Header
+from sensor_msgs.msg import LaserScan
+from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
+from nav_msgs.srv import GetMap
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from tf import TransformListener, TransformBroadcaster
+
+import numpy as np
+
+from pf import ParticleFilter, Particle, DEFAULT_FIELD_CACHE_DIR
+from sensor_model import CoarseToFineModel
+from map_manager import MapManager
+from multi_robot import update_filters
+from resampling import get_random_state
+from particle_output import RateLimiter, select_particles, yaw_quaternions
+from instrumentation import FilterInstrumentation
+from scan_pipeline import LatestOnlyQueue
+
+from helper_functions import (convert_pose_inverse_transform,
+                              convert_translation_rotation_to_pose,
+                              convert_pose_to_xy_and_theta)
+
+
+class Robot(object):
+    """ The filter of one robot, and what the node needs to talk to the robot
+        Attributes:
+            namespace: the namespace of the robot's topics and the prefix of its frames
+            base_frame: the robot's base frame (e.g. "robot1/base_link")
+            odom_frame: the robot's odometry frame (e.g. "robot1/odom")
+            core: the robot's ParticleFilterCore
+            scan_queue: holds only the robot's newest scan (with its odometry pose) waiting for the next tick
+            current_odom_xy_theta: the odometry pose of the last filter update as a (x, y, theta) triple
+            robot_pose: the estimate of the robot's pose as a geometry_msgs/Pose
+            transform: the (translation, rotation) of the map to odom transform, None until the first update
+            particle_pub: publishes the robot's particle cloud
+            pose_pub: publishes the estimate of the robot's pose with its covariance
+            particle_publish_limiter: limits how often the particle cloud is published
+            particles_changed: True when the particle cloud has changed since it was last published
+    """
+
+    def __init__(self, namespace, core, base_frame, odom_frame, particle_publish_rate):
+        self.namespace = namespace
+        self.base_frame = namespace + '/' + base_frame
+        self.odom_frame = namespace + '/' + odom_frame
+        self.core = core
+        self.scan_queue = LatestOnlyQueue()
+        self.current_odom_xy_theta = None
+        self.robot_pose = None
+        self.transform = None
+        self.particle_pub = rospy.Publisher(namespace + '/particlecloud', PoseArray, queue_size=10)
+        self.pose_pub = rospy.Publisher(namespace + '/estimated_pose', PoseWithCovarianceStamped, queue_size=10)
+        self.particle_publish_limiter = RateLimiter(particle_publish_rate)
+        self.particles_changed = False
+
+    def update_robot_pose(self):
+        """ Update robot_pose from the estimate of the filter """
+        x, y, theta = self.core.robot_xy_theta
+        self.robot_pose = Particle(x, y, theta).as_pose()
+
+
+class MultiRobotParticleFilter(object):
+    """ The multi-robot particle filter ROS node
+        Attributes:
+            map_frame: the name of the map coordinate frame shared by all of the robots
+            d_thresh, a_thresh: the amount of linear and angular movement before a robot's filter is updated
+            occupancy_field: the OccupancyField of the map, shared by the filters of all of the robots
+            sensor_model: the laser measurement model, shared by the filters of all of the robots
+            robots: the Robots, in the order of ~robots
+            update_rate: how many times per second the filters of the robots with new scans are updated
+            max_batch: the most particles to score in one call of the sensor model (see multi_robot.py).  It is
+                       0 (no batching) with ~coarse_to_fine.
+            max_scan_age: scans older than this (in seconds) when a tick gets to them are dropped (0 to keep all)
+            start_global: if True the particles start spread over the free space of the whole map
+            max_published_particles, particle_output: which particles to publish (see pf.py)
+            instrumentation: the latency of the batched updates, scan counters and queue lag
+            filter_lock: serializes changes to the particle clouds between the update thread and the callbacks
+            transform_lock: protects the map to odom transforms shared with broadcast_last_transforms
+    """
+
+    def __init__(self):
+        self.initialized = False
+        rospy.init_node('multi_pf')
+
+        self.map_frame = "map"
+        self.d_thresh = 0.1
+        self.a_thresh = math.pi/12
+
+        self.instrumentation = FilterInstrumentation(enabled=rospy.get_param('~instrumentation', True))
+        self.diagnostics_period = rospy.Duration(rospy.get_param('~diagnostics_period', 1.0))
+        self.last_diagnostics_time = rospy.Time(0)
+        self.diagnostics_pub = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size=1)
+        self.update_rate = rospy.get_param('~update_rate', 10.0)
+        self.max_batch = rospy.get_param('~max_batch', 2048)
+        self.max_scan_age = rospy.get_param('~max_scan_age', 1.0)
+        self.start_global = rospy.get_param('~global_localization', False)
+        self.max_published_particles = rospy.get_param('~max_published_particles', 1000)
+        self.particle_output = rospy.get_param('~particle_output', 'top')
+        self.filter_lock = threading.Lock()
+        self.transform_lock = threading.Lock()
+
+        # one listener for the transforms of every robot, instead of one per robot that each buffer all of them
+        self.tf_listener = TransformListener()
+        self.tf_broadcaster = TransformBroadcaster()
+
+        # load the map straight from its files when ~map_file is set, and otherwise request it from the map server
+        map = rospy.get_param('~map_file', '')
+        if not map:
+            rospy.wait_for_service('static_map')
+            map = rospy.ServiceProxy('static_map', GetMap)().map
+        map_manager = MapManager({'map': map},
+                                 cache_dir=rospy.get_param('~field_cache_dir', DEFAULT_FIELD_CACHE_DIR),
+                                 crop=rospy.get_param('~crop_map', True),
+                                 margin=rospy.get_param('~crop_margin', 0.5))
+        self.occupancy_field = map_manager.get('map')
+        self.sensor_model = ParticleFilter.make_sensor_model(self.occupancy_field)
+        if isinstance(self.sensor_model, CoarseToFineModel):
+            # coarse to fine scoring prunes the particles it is given by ranking them against each other, which
+            # would let one robot's particles crowd out another's, so every robot is scored on its own
+            self.max_batch = 0
+
+        seed = rospy.get_param('~random_seed', None)
+        self.robots = []
+        for i, namespace in enumerate(rospy.get_param('~robots')):
+            core = ParticleFilter.make_filter_core(self.occupancy_field, self.sensor_model)
+            if seed is not None:
+                # give every robot its own stream of random numbers
+                core.random_state = get_random_state(seed + i)
+            robot = Robot(namespace, core, rospy.get_param('~base_frame', 'base_link'),
+                          rospy.get_param('~odom_frame', 'odom'), rospy.get_param('~particle_publish_rate', 5.0))
+            rospy.Subscriber(namespace + '/' + rospy.get_param('~scan_topic', 'scan'), LaserScan, self.scan_received,
+                             callback_args=robot, queue_size=1)
+            rospy.Subscriber(namespace + '/initialpose', PoseWithCovarianceStamped, self.update_initial_pose,
+                             callback_args=robot)
+            self.robots.append(robot)
+
+        self.update_thread = threading.Thread(target=self.run_updates, name="filter_updates")
+        self.update_thread.daemon = True
+        self.update_thread.start()
+        rospy.loginfo("localizing %d robots in one %dx%d map", len(self.robots), self.occupancy_field.map.info.width,
+                      self.occupancy_field.map.info.height)
+        self.initialized = True
+
+    def scan_received(self, msg, robot):
+        """ Callback for the scans of every robot.  It looks up the robot's odometry pose at the time of the
+            scan, and queues the scan for the next tick. """
+        instrumentation = self.instrumentation
+        instrumentation.count('scans received')
+        if not self.initialized:
+            instrumentation.count('scans skipped (not initialized)')
+            return
+        if not self.tf_listener.canTransform(robot.base_frame, robot.odom_frame, msg.header.stamp):
+            instrumentation.count('scans skipped (no odom transform)')
+            return
+        p = PoseStamped(header=Header(stamp=msg.header.stamp, frame_id=robot.base_frame), pose=Pose())
+        odom_pose = self.tf_listener.transformPose(robot.odom_frame, p)
+        if robot.scan_queue.put((msg, odom_pose)):
+            instrumentation.count('scans dropped (superseded)')
+
+    def update_initial_pose(self, msg, robot):
+        """ Callback that re-initializes the filter of a robot around a pose estimate (e.g. from rviz) """
+        if not self.initialized:
+            return
+        with self.filter_lock:
+            robot.core.initialize_particle_cloud(convert_pose_to_xy_and_theta(msg.pose.pose))
+            robot.update_robot_pose()
+            self.fix_map_to_odom_transform(robot, msg)
+            robot.particles_changed = True
+
+    def run_updates(self):
+        """ Runs on the update thread: once every tick, take the newest scan of every robot that has one and
+            update the filters of all of them together """
+        rate = rospy.Rate(self.update_rate)
+        while not rospy.is_shutdown():
+            items = []
+            for robot in self.robots:
+                item = robot.scan_queue.get(0)
+                if item is not None:
+                    items.append((robot, item))
+            if items:
+                try:
+                    self.process_scans(items)
+                except Exception:
+                    # the failures of single robots are handled in process_scans, but nothing may kill this thread,
+                    # or none of the robots would be localized again
+                    self.instrumentation.count('ticks failed')
+                    rospy.logerr("failed to update the filters:\n%s", traceback.format_exc())
+            try:
+                rate.sleep()
+            except rospy.ROSInterruptException:
+                break
+
+    def process_scans(self, items):
+        """ Update the filters of the robots with new scans, with the laser update batched over all of them
+            items: a list of (robot, (scan, odometry pose)) """
+        instrumentation = self.instrumentation
+        now = rospy.Time.now()
+        updated = []
+        batch = []
+        clouds = []
+        with self.filter_lock:
+            for robot, (msg, odom_pose) in items:
+                lag = (now - msg.header.stamp).to_sec()
+                # the lag is recorded before stale scans are dropped, or the percentiles would leave the worst out
+                instrumentation.record_lag(lag)
+                if self.max_scan_age and lag > self.max_scan_age:
+                    instrumentation.count('scans dropped (stale)')
+                    continue
+
+                try:
+                    new_odom_xy_theta = convert_pose_to_xy_and_theta(odom_pose.pose)
+                    if not robot.core.particle_cloud or robot.current_odom_xy_theta is None:
+                        # the first scan of the robot.  Its particles may already have been placed (e.g. from
+                        # its initialpose topic), in which case only its odometry pose is recorded.
+                        if not robot.core.particle_cloud:
+                            if self.start_global:
+                                robot.core.initialize_particle_cloud_globally()
+                            else:
+                                robot.core.initialize_particle_cloud(new_odom_xy_theta)
+                        robot.current_odom_xy_theta = new_odom_xy_theta
+                        updated.append((robot, msg))
+                    elif (math.fabs(new_odom_xy_theta[0] - robot.current_odom_xy_theta[0]) > self.d_thresh or
+                          math.fabs(new_odom_xy_theta[1] - robot.current_odom_xy_theta[1]) > self.d_thresh or
+                          math.fabs(new_odom_xy_theta[2] - robot.current_odom_xy_theta[2]) > self.a_thresh):
+                        batch.append((robot, msg, new_odom_xy_theta))
+                    else:
+                        instrumentation.count('scans skipped (not moved)')
+                except Exception:
+                    self.robot_failed(robot)
+
+            if batch:
+                with instrumentation.stage('update (%d robots)' % len(batch)):
+                    # a robot whose update raises is logged and left out, the others are still updated
+                    poses = update_filters([robot.core for robot, _, _ in batch],
+                                           [(robot.current_odom_xy_theta, odom) for robot, _, odom in batch],
+                                           [msg for _, msg, _ in batch], self.sensor_model, self.max_batch,
+                                           on_error=lambda i, exc_info: self.robot_failed(batch[i][0]))
+                for (robot, msg, new_odom_xy_theta), pose in zip(batch, poses):
+                    # the particles of a failed robot may have been moved already, so its odometry is kept
+                    # in step with them either way
+                    robot.current_odom_xy_theta = new_odom_xy_theta
+                    if pose is not None:
+                        updated.append((robot, msg))
+                instrumentation.count('scans processed', sum(pose is not None for pose in poses))
+
+            for robot, msg in updated:
+                # the transforms of one robot failing (e.g. a tf extrapolation error) only skips that robot
+                robot.particles_changed = True
+                try:
+                    robot.update_robot_pose()
+                    self.fix_map_to_odom_transform(robot, msg)
+                    self.publish_pose_estimate(robot, msg.header.stamp)
+                    cloud = self.particles_to_publish(robot)
+                except Exception:
+                    self.robot_failed(robot)
+                    continue
+                if cloud is not None:
+                    clouds.append((robot, cloud))
+
+        with instrumentation.stage('publish'):
+            for robot, cloud in clouds:
+                try:
+                    self.publish_particles(robot, cloud)
+                except Exception:
+                    self.robot_failed(robot)
+
+    def robot_failed(self, robot):
+        """ Log and count an exception raised while handling the scan of one robot """
+        self.instrumentation.count('scans failed')
+        rospy.logerr("failed to process a scan of %s:\n%s", robot.namespace, traceback.format_exc())
+
+    def publish_pose_estimate(self, robot, stamp):
+        """ Publish the estimate of a robot's pose with its covariance (x, y and yaw, the rest are left at 0) """
+        msg = PoseWithCovarianceStamped(header=Header(stamp=stamp, frame_id=self.map_frame))
+        msg.pose.pose = robot.robot_pose
+        covariance = np.zeros((6, 6))
+        covariance[np.ix_((0, 1, 5), (0, 1, 5))] = robot.core.pose_estimate.covariance
+        msg.pose.covariance = covariance.ravel().tolist()
+        robot.pose_pub.publish(msg)
+
+    def particles_to_publish(self, robot):
+        """ Pick the particles of a robot to publish, if they should be published now (see
+            ParticleFilter.particles_to_publish).  Call this with filter_lock held. """
+        if not robot.particles_changed or robot.particle_pub.get_num_connections() == 0:
+            return None
+        if not robot.particle_publish_limiter.ready(rospy.get_time()):
+            return None
+        robot.particles_changed = False
+        particles = robot.core.particle_cloud
+        inds = select_particles(particles, self.max_published_particles, self.particle_output)
+        return particles.x[inds], particles.y[inds], particles.theta[inds]
+
+    def publish_particles(self, robot, cloud):
+        """ Publish the particles of a robot for visualization (see ParticleFilter.publish_particles) """
+        x, y, theta = cloud
+        qz, qw = yaw_quaternions(theta)
+        poses = [Pose(position=Point(x=px, y=py, z=0.0), orientation=Quaternion(x=0.0, y=0.0, z=pz, w=pw))
+                 for px, py, pz, pw in zip(x.tolist(), y.tolist(), qz.tolist(), qw.tolist())]
+        robot.particle_pub.publish(PoseArray(header=Header(stamp=rospy.Time.now(), frame_id=self.map_frame),
+                                             poses=poses))
+
+    def fix_map_to_odom_transform(self, robot, msg):
+        """ Update the offset between the map frame and a robot's odometry frame from the robot's estimated pose """
+        (translation, rotation) = convert_pose_inverse_transform(robot.robot_pose)
+        p = PoseStamped(pose=convert_translation_rotation_to_pose(translation, rotation),
+                        header=Header(stamp=msg.header.stamp, frame_id=robot.base_frame))
+        self.tf_listener.waitForTransform(robot.base_frame, robot.odom_frame, msg.header.stamp, rospy.Duration(1.0))
+        odom_to_map = self.tf_listener.transformPose(robot.odom_frame, p)
+        with self.transform_lock:
+            robot.transform = convert_pose_inverse_transform(odom_to_map.pose)
+
+    def broadcast_last_transforms(self):
+        """ Broadcast the last map to odom transform of every robot that has one """
+        with self.transform_lock:
+            transforms = [(robot.odom_frame, robot.transform) for robot in self.robots if robot.transform is not None]
+        now = rospy.get_rostime()
+        for odom_frame, (translation, rotation) in transforms:
+            self.tf_broadcaster.sendTransform(translation, rotation, now, odom_frame, self.map_frame)
+
+    def publish_diagnostics(self):
+        """ Publish the instrumentation and the number of particles of every robot on /diagnostics, at most once
+            every diagnostics_period """
+        now = rospy.get_rostime()
+        if now - self.last_diagnostics_time < self.diagnostics_period:
+            return
+        self.last_diagnostics_time = now
+        values = self.instrumentation.summary()
+        for robot in self.robots:
+            values.append(('%s particles' % robot.namespace, len(robot.core.particle_cloud)))
+        status = DiagnosticStatus(name=rospy.get_name() + ": multi-robot particle filter", hardware_id=self.map_frame,
+                                  level=DiagnosticStatus.OK, message="%d robots" % len(self.robots),
+                                  values=[KeyValue(key=key, value=str(value)) for key, value in values])
+        self.diagnostics_pub.publish(DiagnosticArray(header=Header(stamp=now), status=[status]))
+
+
+if __name__ == '__main__':
+    n = MultiRobotParticleFilter()
+    r = rospy.Rate(5)
+
+    while not(rospy.is_shutdown()):
+        # broadcast the latest map to odom transform of every robot
+        n.broadcast_last_transforms()
+        n.publish_diagnostics()
+        r.sleep()
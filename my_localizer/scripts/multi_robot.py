@@ -0,0 +1,120 @@
+""" Localizes several robots in the same map in one process.  Every robot has its own ParticleFilterCore,
+    but they all share one OccupancyField, so there is a single read-only distance grid however many
+    robots there are.  On every tick the particles of all of the robots that have a new scan are scored
+    together, with one call of the sensor model: the particle arrays are concatenated and every particle
+    carries the beams of its own robot's scan as a row of (N, B) range and validity arrays. """
+
+import sys
+
+import numpy as np
+
+
+def _score_batch(batch, sensor_model):
+    """ Score the particles of a batch of (core, ranges, angles) in one call, and hand every core its
+        likelihoods """
+    if len(batch) == 1:
+        core, ranges, angles = batch[0]
+        particles = core.particle_cloud
+        core.apply_likelihoods(sensor_model.weights(particles.x, particles.y, particles.theta, ranges, angles))
+        return
+
+    clouds = [core.particle_cloud for core, _, _ in batch]
+    counts = [len(particles) for particles in clouds]
+    # the robots keep different beams of their scans (the ones without a usable range are dropped), but their
+    # scans usually have the same bearings.  Every robot's beams are put in the columns of their bearings among
+    # the bearings of all of the robots, and the columns a robot has no beam in are padding that the sensor model
+    # ignores.  The bearings then stay a (B,) array shared by every particle, which keeps the cheaper computation
+    # of the beam directions (see LikelihoodFieldModel.endpoints).
+    angles = np.unique(np.concatenate([angles for _, _, angles in batch]))
+    if len(angles) >= 2*max(len(ranges) for _, ranges, _ in batch):
+        # the bearings mostly differ between the robots, so the shared columns would be mostly padding.  The beams
+        # are packed to the left instead, and every particle carries its own bearings.
+        columns = [np.arange(len(ranges)) for _, ranges, _ in batch]
+        angles = np.zeros((len(batch), max(len(ranges) for _, ranges, _ in batch)))
+        for row, (_, _, robot_angles) in enumerate(batch):
+            angles[row, :len(robot_angles)] = robot_angles
+        angles = np.repeat(angles, counts, axis=0)
+    else:
+        columns = [np.searchsorted(angles, robot_angles) for _, _, robot_angles in batch]
+    ranges = np.zeros((len(batch), angles.shape[-1]))
+    valid = np.zeros(ranges.shape, dtype=bool)
+    for row, ((_, robot_ranges, _), robot_columns) in enumerate(zip(batch, columns)):
+        ranges[row, robot_columns] = robot_ranges
+        valid[row, robot_columns] = True
+
+    likelihoods = sensor_model.weights(np.concatenate([particles.x for particles in clouds]),
+                                       np.concatenate([particles.y for particles in clouds]),
+                                       np.concatenate([particles.theta for particles in clouds]),
+                                       np.repeat(ranges, counts, axis=0), angles, np.repeat(valid, counts, axis=0))
+    for (core, _, _), core_likelihoods in zip(batch, np.split(likelihoods, np.cumsum(counts)[:-1])):
+        core.apply_likelihoods(core_likelihoods)
+
+
+def batched_laser_update(cores, scans, sensor_model, max_batch=2048):
+    """ Update the particle weights of several filters with a scan each, scoring the particles of several
+        filters at once (see ParticleFilterCore.update_particles_with_laser)
+        cores: the ParticleFilterCores, which must all localize in the map of sensor_model
+        scans: the sensor_msgs/LaserScan of each filter
+        sensor_model: scores the particles (e.g. a LikelihoodFieldModel)
+        max_batch: the most particles to score in one call.  Batching saves the fixed cost of every call, but
+                   once the (N, B) intermediate arrays outgrow the cache every particle costs more.  With 0 every
+                   filter is scored on its own, which is needed when the sensor model does not score every
+                   particle independently of the others (a CoarseToFineModel ranks them against each other). """
+    batch = []
+    n_batch = 0
+    for core, scan in zip(cores, scans):
+        ranges, angles = core.beam_selector.select(scan)
+        if not len(ranges):
+            continue
+        n = len(core.particle_cloud)
+        if batch and n_batch + n > max_batch:
+            _score_batch(batch, sensor_model)
+            batch = []
+            n_batch = 0
+        batch.append((core, ranges, angles))
+        n_batch += n
+    if batch:
+        _score_batch(batch, sensor_model)
+
+
+def update_filters(cores, odom_updates, scans, sensor_model, max_batch=2048, on_error=None):
+    """ Run one full filter update of several filters (see ParticleFilterCore.update), with the laser update
+        of all of them batched together
+        cores: the ParticleFilterCores to update
+        odom_updates: the (old_odom_xy_theta, new_odom_xy_theta) pair of each filter
+        scans: the scan of each filter
+        sensor_model: scores the particles of all of the filters
+        max_batch: the most particles to score in one call (see batched_laser_update)
+        on_error: if given, an exception raised while updating one filter is handed to on_error(index, exc_info)
+                  with the index of that filter, and only that filter is left out of the rest of the update.
+                  Without it the exception is raised.
+        returns: the new estimate of each robot's pose as a (x, y, theta) triple (None for the filters that failed) """
+    def guarded(indices, update):
+        survivors = []
+        for i in indices:
+            try:
+                update(i)
+            except Exception:
+                if on_error is None:
+                    raise
+                on_error(i, sys.exc_info())
+            else:
+                survivors.append(i)
+        return survivors
+
+    ok = guarded(range(len(cores)), lambda i: cores[i].update_particles_with_odom(*odom_updates[i]))
+    try:
+        batched_laser_update([cores[i] for i in ok], [scans[i] for i in ok], sensor_model, max_batch)
+    except Exception:
+        if on_error is None:
+            raise
+        # score every filter on its own to find the one that failed, so the others still get their scan
+        ok = guarded(ok, lambda i: batched_laser_update([cores[i]], [scans[i]], sensor_model, max_batch))
+
+    poses = [None]*len(cores)
+
+    def estimate(i):
+        poses[i] = cores[i].update_robot_pose()
+        cores[i].resample_if_degenerate()
+    guarded(ok, estimate)
+    return poses
@@ -1,90 +1,72 @@
 """ An implementation of an occupancy field that you can use to implement
     your particle filter's laser_update function """
 
-import rospy
+import numpy as np
+from distance_transform import distance_transform
+import field_cache
 
-from std_msgs.msg import Header, String
-from sensor_msgs.msg import LaserScan
-from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
-from nav_msgs.srv import GetMap
-from copy import deepcopy
 
-import tf
-from tf import TransformListener
-from tf import TransformBroadcaster
-from tf.transformations import euler_from_quaternion, rotation_matrix, quaternion_from_matrix
-from random import gauss
+def grid_lookup(grid, origin_x, origin_y, resolution, x, y):
+    """ Look points up in a (height, width) grid whose cell [0, 0] has its corner at (origin_x, origin_y)
+        returns: the value of the cell each point falls in, nan for points outside of the grid, as a float
+                 for scalar coordinates and an array for array coordinates """
+    x_coord = (np.asarray(x, dtype=np.float64) - origin_x)/resolution
+    y_coord = (np.asarray(y, dtype=np.float64) - origin_y)/resolution
+    x_coord, y_coord = np.broadcast_arrays(x_coord, y_coord)
 
-import math
-import time
+    # check if we are in bounds (nan coordinates compare false, so they are never in bounds)
+    in_bounds = ((x_coord >= 0) & (x_coord < grid.shape[1]) &
+                 (y_coord >= 0) & (y_coord < grid.shape[0]))
+
+    # gather through flat indices, with the points that are out of bounds pointed at cell 0 for the moment.
+    # This is much faster than compacting the in bounds points with a boolean mask first.
+    flat = np.where(in_bounds, y_coord.astype(np.intp)*grid.shape[1] + x_coord.astype(np.intp), 0)
+    values = np.where(in_bounds, np.take(grid.ravel(), flat).astype(np.float64), np.nan)
+    if values.ndim == 0:
+        return float(values)
+    return values
 
-import numpy as np
-from numpy.random import random_sample
-from sklearn.neighbors import NearestNeighbors
 
 class OccupancyField(object):
     """ Stores an occupancy field for an input map.  An occupancy field returns the distance to the closest
         obstacle for any coordinate in the map
         Attributes:
             map: the map to localize against (nav_msgs/OccupancyGrid)
-            closest_occ: the distance for each entry in the OccupancyGrid to the closest obstacle
+            closest_occ: a (height, width) float32 array of the distance in meters from each cell of the
+                         OccupancyGrid to the closest obstacle, indexed as closest_occ[y_coord, x_coord].
+                         When a cache directory is given this is a read-only memory map of the cache file.
+            free_cells: the indices of the free cells of the map in the flattened (row major) grid, used to
+                        sample poses uniformly over the free space
+            cache_dir: the directory that arrays precomputed from this map are cached in (None for no cache)
+            cache_key: the key identifying this map in the cache (see field_cache.map_key)
     """
 
-    def __init__(self, map):
+    def __init__(self, map, cache_dir=None):
+        """ Construct the occupancy field for a map
+            map: the map to localize against (nav_msgs/OccupancyGrid)
+            cache_dir: a directory in which to cache the computed field, keyed by the map contents,
+                       resolution and origin.  If it is None the field is always recomputed. """
         self.map = map      # save this for later
-        # build up a numpy array of the coordinates of each grid cell in the map
-        X = np.zeros((self.map.info.width*self.map.info.height,2))
+        # occupancy grids are stored in row major order, so the data reshapes directly into a (height, width) grid
+        grid = np.asarray(self.map.data, dtype=np.int8).reshape((self.map.info.height, self.map.info.width))
 
-        # while we're at it let's count the number of occupied cells
-        total_occupied = 0
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order, if you go through this right, you might be able to use curr
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    total_occupied += 1
-                X[curr,0] = float(i)
-                X[curr,1] = float(j)
-                curr += 1
+        self.cache_dir = cache_dir
+        self.cache_key = field_cache.map_key(grid, self.map.info)
 
-        # build up a numpy array of the coordinates of each occupied grid cell in the map
-        O = np.zeros((total_occupied,2))
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order, if you go through this right, you might be able to use curr
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    O[curr,0] = float(i)
-                    O[curr,1] = float(j)
-                    curr += 1
+        def compute_field():
+            # use an exact euclidean distance transform, which runs in time linear in the number of cells
+            distances = distance_transform(grid > 0)
+            return np.asarray(distances*self.map.info.resolution, dtype=np.float32)
 
-        # use super fast scikit learn nearest neighbor algorithm
-        nbrs = NearestNeighbors(n_neighbors=1,algorithm="ball_tree").fit(O)
-        distances, indices = nbrs.kneighbors(X)
+        self.closest_occ = field_cache.load_cached_array(cache_dir, "closest_occ", self.cache_key, compute_field)
 
-        self.closest_occ = {}
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                ind = i + j*self.map.info.width
-                self.closest_occ[ind] = distances[curr][0]*self.map.info.resolution
-                curr += 1
+        # index the free cells once, so that global localization only has to draw from this array
+        self.free_cells = np.flatnonzero(grid == 0)
 
     def get_closest_obstacle_distance(self,x,y):
         """ Compute the closest obstacle to the specified (x,y) coordinate in the map.  If the (x,y) coordinate
-            is out of the map boundaries, nan will be returned. """
-        x_coord = int((x - self.map.info.origin.position.x)/self.map.info.resolution)
-        y_coord = int((y - self.map.info.origin.position.y)/self.map.info.resolution)
-
-        # check if we are in bounds
-        if x_coord > self.map.info.width or x_coord < 0:
-            return float('nan')
-        if y_coord > self.map.info.height or y_coord < 0:
-            return float('nan')
-
-        ind = x_coord + y_coord*self.map.info.width
-        if ind >= self.map.info.width*self.map.info.height or ind < 0:
-            return float('nan')
-        return self.closest_occ[ind]
\ No newline at end of file
+            is out of the map boundaries, nan will be returned.
+            x and y may also be arrays of the same shape, in which case an array of distances is
+            returned, with nan for every point that is out of the map boundaries. """
+        return grid_lookup(self.closest_occ, self.map.info.origin.position.x, self.map.info.origin.position.y,
+                           self.map.info.resolution, x, y)
\ No newline at end of file
@@ -0,0 +1,86 @@
+""" A parallel backend for the laser likelihood.  The particle arrays are split into contiguous
+    shards that are scored concurrently by a pool of threads or processes, and the weights are
+    concatenated back in order.  Every particle's weight only depends on that particle, so the
+    result is identical to scoring all of the particles on a single core.  That does not hold for a
+    CoarseToFineModel, which ranks the particles against each other, so it is refused here (it
+    parallelizes each of its levels itself instead).
+
+    The distance grid is never copied per worker.  Threads share the parent's arrays directly.
+    Processes are forked after the pool is created with the sensor model, so they inherit the grid
+    (which is read-only, and usually a memory map of the field cache file) as shared pages. """
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from sensor_model import CoarseToFineModel
+
+# the sensor model of a worker process, inherited from the parent when the pool forks
+_worker_model = None
+
+
+def _init_worker(sensor_model):
+    global _worker_model
+    _worker_model = sensor_model
+
+
+def _shard_beams(beams, start, end):
+    """ Per particle (N, B) beams are split along with the particles, shared (B,) beams are not """
+    return beams[start:end] if np.ndim(beams) == 2 else beams
+
+
+def _score_shard(args):
+    x, y, theta, ranges, angles, valid = args
+    return _worker_model.weights(x, y, theta, ranges, angles, valid)
+
+
+class ParallelLikelihoodModel(object):
+    """ Scores particles with a sensor model, spreading large particle sets over several cores
+        Attributes:
+            sensor_model: the model that scores each shard (e.g. a LikelihoodFieldModel)
+            workers: the number of threads or processes in the pool
+            backend: 'thread' (numpy releases the GIL in the heavy array operations) or 'process'
+            min_shard: particle sets smaller than workers*min_shard are split into fewer shards, since
+                       below that the overhead of the pool outweighs the parallelism
+    """
+
+    def __init__(self, sensor_model, workers=None, backend='thread', min_shard=2048):
+        if isinstance(sensor_model, CoarseToFineModel):
+            raise ValueError("a CoarseToFineModel prunes the particles by ranking them against each other, so it can't "
+                             "be split into shards; give it workers instead")
+        self.sensor_model = sensor_model
+        self.workers = workers or multiprocessing.cpu_count()
+        self.backend = backend
+        self.min_shard = min_shard
+        if backend == 'thread':
+            self._pool = ThreadPool(self.workers)
+        elif backend == 'process':
+            self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(sensor_model,))
+        else:
+            raise ValueError("unknown parallel backend %r (expected 'thread' or 'process')" % backend)
+
+    def weights(self, x, y, theta, ranges, angles, valid=None):
+        """ Compute the (unnormalized) weight of each particle given a scan (see LikelihoodFieldModel.weights) """
+        n = len(x)
+        n_shards = int(min(self.workers, max(1, n//self.min_shard)))
+        if n_shards == 1:
+            return self.sensor_model.weights(x, y, theta, ranges, angles, valid)
+
+        bounds = np.linspace(0, n, n_shards + 1).astype(np.intp)
+        shards = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            shards.append((x[start:end], y[start:end], theta[start:end],
+                           _shard_beams(ranges, start, end), _shard_beams(angles, start, end),
+                           None if valid is None else valid[start:end]))
+
+        if self.backend == 'thread':
+            results = self._pool.map(lambda shard: self.sensor_model.weights(*shard), shards)
+        else:
+            results = self._pool.map(_score_shard, shards)
+        return np.concatenate(results)
+
+    def close(self):
+        """ Shut the pool down """
+        self._pool.close()
+        self._pool.join()
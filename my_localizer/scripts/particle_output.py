@@ -0,0 +1,49 @@
+""" Helpers for publishing the particle cloud for visualization without letting it cost more than the
+    filter: a rate limit, a choice of which particles to publish when there are too many, and the
+    orientations of all of the particles computed at once. """
+
+import numpy as np
+
+
+class RateLimiter(object):
+    """ Lets something happen at most rate times per second
+        Attributes:
+            period: the shortest time (in seconds) allowed between two events, 0 for no limit
+            last: the time of the last event, None if there was none yet
+    """
+
+    def __init__(self, rate):
+        self.period = 1.0/rate if rate > 0 else 0.0
+        self.last = None
+
+    def ready(self, now):
+        """ Check whether the event may happen at time now (in seconds), and if so record that it does """
+        if self.last is not None and now - self.last < self.period:
+            return False
+        self.last = now
+        return True
+
+
+def select_particles(particles, max_particles=0, mode='top'):
+    """ Choose at most max_particles particles to publish
+        particles: the ParticleSet
+        max_particles: the most particles to choose, 0 to choose all of them
+        mode: 'top' for the particles with the largest weights, or 'decimate' for every n-th particle (the
+              particles are in no particular order, so this is a uniform subsample of the cloud)
+        returns: an array of particle indices """
+    n = len(particles)
+    if max_particles <= 0 or n <= max_particles:
+        return np.arange(n)
+    if mode == 'top':
+        # argpartition finds the largest weights in linear time, without sorting them
+        return np.argpartition(-particles.w, max_particles - 1)[:max_particles]
+    if mode == 'decimate':
+        return np.linspace(0, n, max_particles, endpoint=False).astype(np.intp)
+    raise ValueError("unknown particle selection mode %r (expected 'top' or 'decimate')" % mode)
+
+
+def yaw_quaternions(theta):
+    """ Compute the quaternions of rotations by theta about the z axis.  Their x and y components are 0.
+        returns: arrays of the z and w components """
+    half = 0.5*np.asarray(theta)
+    return np.sin(half), np.cos(half)
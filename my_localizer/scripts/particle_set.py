@@ -0,0 +1,94 @@
+""" A structure-of-arrays representation of the particle cloud.  Every particle filter
+    stage operates on whole arrays instead of looping over individual particle objects """
+
+import math
+
+import numpy as np
+
+
+class ParticleSet(object):
+    """ Represents a set of hypotheses (particles) of the robot's pose as contiguous arrays
+        Attributes:
+            x: the x-coordinates of the hypotheses relative to the map frame (float64 array)
+            y: the y-coordinates of the hypotheses relative to the map frame (float64 array)
+            theta: the yaws of the hypotheses relative to the map frame (float64 array)
+            w: the particle weights (the class does not ensure that particle weights are normalized)
+    """
+
+    def __init__(self, x=(), y=(), theta=(), w=None):
+        """ Construct a new ParticleSet from array-likes of equal length.  If w is ommitted
+            every particle is given a weight of 1.0 """
+        self.x = np.array(x, dtype=np.float64)
+        self.y = np.array(y, dtype=np.float64)
+        self.theta = np.array(theta, dtype=np.float64)
+        if w is None:
+            self.w = np.ones(self.x.shape[0])
+        else:
+            self.w = np.array(w, dtype=np.float64)
+        if not (self.x.shape == self.y.shape == self.theta.shape == self.w.shape):
+            raise ValueError("particle arrays must all have the same length")
+
+    @classmethod
+    def around_pose(cls, xy_theta, n, lin_noise, ang_noise, random_state=np.random):
+        """ Create n particles scattered uniformly around a pose
+            xy_theta: a triple consisting of the mean x, y, and theta (yaw)
+            lin_noise: the width of the uniform distribution in x and y
+            ang_noise: the width of the uniform distribution in theta
+            random_state: the source of random numbers (a numpy RandomState or the numpy.random module) """
+        x = xy_theta[0] + (random_state.random_sample(n)*lin_noise - lin_noise/2.0)
+        y = xy_theta[1] + (random_state.random_sample(n)*lin_noise - lin_noise/2.0)
+        theta = xy_theta[2] + (random_state.random_sample(n)*ang_noise - ang_noise/2.0)
+        return cls(x, y, theta)
+
+    @classmethod
+    def in_free_space(cls, occupancy_field, n, random_state=np.random):
+        """ Create n particles spread uniformly over the free space of a map, with uniformly random headings
+            occupancy_field: the OccupancyField of the map (its free_cells are the cells drawn from)
+            random_state: the source of random numbers (a numpy RandomState or the numpy.random module) """
+        free_cells = occupancy_field.free_cells
+        if not len(free_cells):
+            raise ValueError("the map has no free cells to place particles in")
+        info = occupancy_field.map.info
+        rows, cols = np.divmod(free_cells[random_state.randint(len(free_cells), size=n)], info.width)
+
+        # place each particle anywhere inside its cell, not just at the center
+        x = info.origin.position.x + (cols + random_state.random_sample(n))*info.resolution
+        y = info.origin.position.y + (rows + random_state.random_sample(n))*info.resolution
+        theta = random_state.uniform(-math.pi, math.pi, n)
+        return cls(x, y, theta)
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    __bool__ = __nonzero__
+
+    def normalize(self):
+        """ Make sure the particle weights define a valid distribution (i.e. sum to 1.0).  If the weights
+            sum to zero (or are not finite) there is nothing to normalize, so the weights are made uniform.
+            returns: False if the weights had to be made uniform, True otherwise """
+        total = np.sum(self.w)
+        if not (0 < total < np.inf):
+            self.w.fill(1.0/len(self) if len(self) else 0.0)
+            return False
+        self.w /= total
+        return True
+
+    def gather(self, indices):
+        """ Return a new ParticleSet made of the particles at the given indices.  Repeated
+            indices produce independent copies of the same particle. """
+        indices = np.asarray(indices, dtype=np.intp)
+        return ParticleSet(self.x[indices], self.y[indices], self.theta[indices], self.w[indices])
+
+    def mean_pose(self):
+        """ Compute the weighted mean pose of the particles as a (x,y,theta) triple.
+            The weights are assumed to be normalized. """
+        x = np.dot(self.w, self.x)
+        y = np.dot(self.w, self.y)
+
+        # angle is calculated using trig to account for angle runover
+        theta_x = np.dot(self.w, np.cos(self.theta))
+        theta_y = np.dot(self.w, np.sin(self.theta))
+        return (float(x), float(y), math.atan2(float(theta_y), float(theta_x)))
@@ -28,6 +28,9 @@ from std_msgs.msg import Header, String
 from sensor_msgs.msg import LaserScan, PointCloud
 from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
 from nav_msgs.srv import GetMap
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from std_srvs.srv import Empty, EmptyResponse
+from my_localizer.srv import SwitchMap, SwitchMapResponse
 from copy import deepcopy
 
 import tf
@@ -37,18 +40,35 @@ from tf.transformations import euler_from_quaternion, rotation_matrix, quaternio
 from random import gauss
 
 import math
+import os
+import threading
 import time
+import traceback
 
 import numpy as np
 from numpy.random import random_sample
-from sklearn.neighbors import NearestNeighbors
-from occupancy_field import OccupancyField
+from map_manager import MapManager
+from filter_core import ParticleFilterCore
+from sensor_model import LikelihoodFieldModel, CoarseToFineModel, BeamRangeModel
+from range_table import RangeTable
+from field_pyramid import DistanceFieldPyramid
+from parallel_likelihood import ParallelLikelihoodModel
+from beam_selection import BeamSelector
+from resampling import RESAMPLERS
+from motion_model import OdometryMotionModel
+from pose_estimation import ClusterPoseEstimator
+from particle_output import RateLimiter, select_particles, yaw_quaternions
+from instrumentation import FilterInstrumentation
+from scan_pipeline import LatestOnlyQueue, ScanWorker
 
 from helper_functions import (convert_pose_inverse_transform,
                               convert_translation_rotation_to_pose,
                               convert_pose_to_xy_and_theta,
                               angle_diff)
 
+# by default precomputed occupancy fields are cached next to the map files
+DEFAULT_FIELD_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps', 'field_cache')
+
 
 class Particle(object):
     """ Represents a hypothesis (particle) of the robot's pose consisting of x,y and theta (yaw)
@@ -85,19 +105,49 @@ class ParticleFilter:
             map_frame: the name of the map coordinate frame (should be "map" in most cases)
             odom_frame: the name of the odometry coordinate frame (should be "odom" in most cases)
             scan_topic: the name of the scan topic to listen to (should be "scan" in most cases)
-            n_particles: the number of particles in the filter
             d_thresh: the amount of linear movement before triggering a filter update
             a_thresh: the amount of angular movement before triggering a filter update
             laser_max_distance: the maximum distance to an obstacle we should use in a likelihood calculation
             pose_listener: a subscriber that listens for new approximate pose estimates (i.e. generated through the rviz GUI)
             particle_pub: a publisher for the particle cloud
+            particle_publish_limiter: limits how often the particle cloud is published (~particle_publish_rate)
+            max_published_particles: the most particles to publish, 0 for all of them
+            particle_output: which particles to publish when there are too many, 'top' (the heaviest ones)
+                             or 'decimate' (an evenly spaced subsample)
+            particles_changed: True when the particle cloud has changed since it was last published
+            pose_pub: publishes the estimate of the robot's pose with its covariance after every filter update
             laser_subscriber: listens for new scan data on topic self.scan_topic
             tf_listener: listener for coordinate transforms
             tf_broadcaster: broadcaster for coordinate transforms
-            particle_cloud: a list of particles representing a probability distribution over robot poses
             current_odom_xy_theta: the pose of the robot in the odometry frame when the last filter update was performed.
                                    The pose is expressed as a list [x,y,theta] (where theta is the yaw)
             map: the map we will be localizing ourselves in.  The map should be of type nav_msgs/OccupancyGrid
+            field_cache_dir: the directory where precomputed occupancy fields are cached between launches
+                             (set the ~field_cache_dir parameter to an empty string to disable the cache)
+            core: the ROS independent ParticleFilterCore, which holds the particle cloud and runs the
+                  filter updates.  Its settings are read from the node's private parameters.
+            instrumentation: per-stage latency histograms, scan counters and queue lag of scan_received.
+                             A profiler can be attached in process by setting instrumentation.profiler_hook.
+            diagnostics_pub: publishes the instrumentation on /diagnostics every diagnostics_period seconds
+            max_queue_lag: the queue lag (in seconds) above which the diagnostics report a warning
+            scan_queue: holds only the newest scan (with the laser and odometry poses at its time) waiting to be processed
+            scan_worker: the thread that runs the filter updates, so that they never block the rospy callbacks
+            max_scan_age: scans older than this (in seconds) when the worker gets to them are dropped (0 to keep all)
+            filter_lock: serializes changes to the particle cloud between the worker and the initialpose callback
+            transform_lock: protects the map to odom transform shared with broadcast_last_transform
+            start_global: if True the particles start spread over the free space of the whole map instead
+                          of around the odometry pose (set with the ~global_localization parameter)
+            global_localization_service: re-initializes the particles over the whole map when called, for
+                                         recovering when the robot is lost or has been kidnapped
+            map_manager: keeps the occupancy fields of the maps the node can localize in (the ~maps parameter,
+                         or the single map of ~map_file or the map server) resident within a memory budget
+            map_name: the name of the map the filter is currently localizing in
+            map_name_pub: publishes (latched) the name of the current map whenever it changes
+            switch_map_service: switches to another map when called, optionally picking the map that best
+                                explains the latest scan
+            last_scan: the latest scan that was processed, for picking a map to switch to and for fixing the map
+                       to odom transform right after the particles are replaced
+            map_search_particles: the number of poses tried per map and round when picking a map from a scan
     """
     def __init__(self):
         self.initialized = False        # make sure we don't perform updates before everything is setup
@@ -108,13 +158,29 @@ class ParticleFilter:
         self.odom_frame = "odom"        # the name of the odometry coordinate frame
         self.scan_topic = "scan"        # the topic where we will get laser scans from
 
-        self.n_particles = 500          # the number of particles to use
-
         self.d_thresh = 0.1             # the amount of linear movement before performing an update
         self.a_thresh = math.pi/12       # the amount of angular movement before performing an update
 
         self.laser_max_distance = 2.0   # maximum penalty to assess in the likelihood field model
 
+        # where to cache the occupancy field so that it only has to be computed once per map
+        self.field_cache_dir = rospy.get_param('~field_cache_dir', DEFAULT_FIELD_CACHE_DIR)
+
+        # time every stage of the update, and report the timings on /diagnostics
+        self.instrumentation = FilterInstrumentation(enabled=rospy.get_param('~instrumentation', True))
+        self.diagnostics_period = rospy.Duration(rospy.get_param('~diagnostics_period', 1.0))
+        self.max_queue_lag = rospy.get_param('~max_queue_lag', 0.5)
+        self.last_diagnostics_time = rospy.Time(0)
+
+        # scans are processed on a worker thread, which only ever sees the newest scan
+        self.scan_queue = LatestOnlyQueue()
+        self.max_scan_age = rospy.get_param('~max_scan_age', 1.0)
+        self.filter_lock = threading.Lock()
+        self.transform_lock = threading.Lock()
+
+        # start with the robot's pose unknown, rather than near the odometry pose
+        self.start_global = rospy.get_param('~global_localization', False)
+
         # Setup pubs and subs
 
         # pose_listener responds to selection of a new approximate robot location (for instance using rviz)
@@ -122,15 +188,27 @@ class ParticleFilter:
 
         # publish the current particle cloud.  This enables viewing particles in rviz.
         self.particle_pub = rospy.Publisher("particlecloud", PoseArray, queue_size=10)
+        self.pose_pub = rospy.Publisher("estimated_pose", PoseWithCovarianceStamped, queue_size=10)
+        # publishing thousands of particles costs more than the filter, so it is rate limited and decimated
+        self.particle_publish_limiter = RateLimiter(rospy.get_param('~particle_publish_rate', 5.0))
+        self.max_published_particles = rospy.get_param('~max_published_particles', 1000)
+        self.particle_output = rospy.get_param('~particle_output', 'top')
+        self.particles_changed = False
+        self.diagnostics_pub = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size=1)
+        # spreads the particles over the whole map when called (same name and type as amcl's)
+        self.global_localization_service = rospy.Service("global_localization", Empty, self.global_localization)
+        # switches between the maps of ~maps at runtime (e.g. when the robot takes the elevator to another floor)
+        self.switch_map_service = rospy.Service("switch_map", SwitchMap, self.switch_map)
+        self.map_name_pub = rospy.Publisher("current_map", String, queue_size=1, latch=True)
+        self.map_search_particles = rospy.get_param('~map_search_particles', 5000)
+        self.last_scan = None
         # laser_subscriber listens for data from the lidar
-        rospy.Subscriber(self.scan_topic, LaserScan, self.scan_received)
+        rospy.Subscriber(self.scan_topic, LaserScan, self.scan_received, queue_size=1)
 
         # enable listening for and broadcasting coordinate transforms
         self.tf_listener = TransformListener()
         self.tf_broadcaster = TransformBroadcaster()
 
-        self.particle_cloud = []
-
         # change use_projected_stable_scan to True to use point clouds instead of laser scans
         self.use_projected_stable_scan = False
         self.last_projected_stable_scan = None
@@ -140,46 +218,130 @@ class ParticleFilter:
 
         self.current_odom_xy_theta = []
 
-        # request the map from the map server
-    	rospy.wait_for_service('static_map')
-    	try:
-            map_server = rospy.ServiceProxy('static_map', GetMap)
-            map = map_server().map
-            print map.info.resolution
-    	except:
-    		print "Service call failed!"
-
-        # initializes the occupancyfield which contains the map
-        self.occupancy_field = OccupancyField(map)
+        # the maps to localize in, as a dict from names to the paths of their .yaml files.  Their occupancy fields
+        # are loaded on first use, and the least recently used ones are dropped when they take up more than
+        # ~map_memory_budget_mb.  Most scanned maps are mostly unknown margin, which is cropped away.
+        self.map_manager = MapManager(rospy.get_param('~maps', {}),
+                                      memory_budget=rospy.get_param('~map_memory_budget_mb', 512)*2**20,
+                                      cache_dir=self.field_cache_dir,
+                                      crop=rospy.get_param('~crop_map', True),
+                                      margin=rospy.get_param('~crop_margin', 0.5))
+        if self.map_manager.names():
+            self.map_name = rospy.get_param('~initial_map', self.map_manager.names()[0])
+        else:
+            # load the map straight from its files when ~map_file is set (no map_server needed), and otherwise
+            # request it from the map server
+            map = rospy.get_param('~map_file', '')
+            if not map:
+                rospy.wait_for_service('static_map')
+                try:
+                    map_server = rospy.ServiceProxy('static_map', GetMap)
+                    map = map_server().map
+                    print map.info.resolution
+                except:
+                    print "Service call failed!"
+            self.map_name = 'map'
+            self.map_manager.add_map(self.map_name, map)
+
+        # initializes the occupancyfield which contains the map, and the filter that localizes us in it
+        self.occupancy_field = self.map_manager.get(self.map_name)
+        self.core = self.make_filter_core(self.occupancy_field)
+        self.map_name_pub.publish(String(data=self.map_name))
+        self.scan_worker = ScanWorker(self.scan_queue, self.process_scan, rospy.is_shutdown,
+                                      on_error=self.scan_failed)
+        self.scan_worker.start()
         print "initialized"
         self.initialized = True
 
 
+    @staticmethod
+    def make_sensor_model(occupancy_field):
+        """ Create the laser measurement model for a map, configured from the node's private parameters """
+        sensor_model = LikelihoodFieldModel(occupancy_field)
+        if rospy.get_param('~sensor_model', 'likelihood_field') == 'beam':
+            # compare every beam to the range it should measure, which accounts for occlusions.  The expected
+            # ranges are ray cast once per map and cached next to the occupancy field.
+            range_table = RangeTable(occupancy_field, n_headings=rospy.get_param('~range_table_headings', 72),
+                                     max_range=rospy.get_param('~range_table_max_range', 5.0))
+            sensor_model = BeamRangeModel(range_table, z_hit=rospy.get_param('~z_hit', 0.95),
+                                          z_short=rospy.get_param('~z_short', 0.1),
+                                          z_max=rospy.get_param('~z_max', 0.05),
+                                          z_rand=rospy.get_param('~z_rand', 0.05),
+                                          sigma_hit=rospy.get_param('~sigma_hit', 0.2),
+                                          lambda_short=rospy.get_param('~lambda_short', 0.1),
+                                          independent_beams=rospy.get_param('~independent_beams', 10))
+        elif rospy.get_param('~coarse_to_fine', False):
+            # rank large particle sets on downsampled copies of the field with fewer beams first, and only score
+            # the best of them with every beam at full resolution.  The pruning ranks all of the particles
+            # together, so with ~likelihood_workers each level is split between threads instead of the whole model.
+            if (rospy.get_param('~likelihood_workers', 1) > 1 and
+                    rospy.get_param('~likelihood_backend', 'thread') != 'thread'):
+                rospy.logwarn("coarse to fine scoring only runs on threads, ignoring ~likelihood_backend")
+            pyramid = DistanceFieldPyramid(occupancy_field, factors=rospy.get_param('~pyramid_factors', [4, 16]))
+            return CoarseToFineModel(sensor_model, pyramid,
+                                     keep_fraction=rospy.get_param('~coarse_keep_fraction', 0.25),
+                                     beam_stride=rospy.get_param('~coarse_beam_stride', 2),
+                                     min_particles=rospy.get_param('~coarse_min_particles', 1000),
+                                     workers=rospy.get_param('~likelihood_workers', 1))
+        if rospy.get_param('~likelihood_workers', 1) > 1:
+            # score large particle sets on several cores (with a 'thread' or 'process' pool)
+            sensor_model = ParallelLikelihoodModel(sensor_model, workers=rospy.get_param('~likelihood_workers'),
+                                                   backend=rospy.get_param('~likelihood_backend', 'thread'))
+        return sensor_model
+
+    @staticmethod
+    def make_filter_core(occupancy_field, sensor_model=None):
+        """ Create the particle filter core for a map, configured from the node's private parameters
+            sensor_model: the laser measurement model, by default a new one made by make_sensor_model """
+        return ParticleFilterCore(
+            occupancy_field,
+            n_particles=rospy.get_param('~n_particles', 500),
+            # the noise of the odometry in terms of the standard alpha1-alpha4 parameters (rotation from rotation,
+            # rotation from translation, translation from translation and translation from rotation)
+            motion_model=OdometryMotionModel(alpha1=rospy.get_param('~odom_alpha1', 0.2),
+                                             alpha2=rospy.get_param('~odom_alpha2', 0.2),
+                                             alpha3=rospy.get_param('~odom_alpha3', 0.2),
+                                             alpha4=rospy.get_param('~odom_alpha4', 0.2)),
+            sensor_model=sensor_model or ParticleFilter.make_sensor_model(occupancy_field),
+            # which beams of each scan to use.  With the defaults every 10th beam is used (36 beams of a Neato scan),
+            # ~max_beams caps the number of beams and ~informative_beams drops max-range and near-duplicate beams
+            beam_selector=BeamSelector(stride=rospy.get_param('~beam_stride', 10),
+                                       max_beams=rospy.get_param('~max_beams', 0),
+                                       informative=rospy.get_param('~informative_beams', False),
+                                       duplicate_tolerance=rospy.get_param('~duplicate_beam_tolerance', 0.05)),
+            # the pose estimate is the mean of the heaviest cluster of particles, where particles in neighbouring
+            # (x, y, theta) bins of these sizes are in the same cluster
+            pose_estimator=ClusterPoseEstimator(bin_size=(rospy.get_param('~cluster_bin_xy', 0.5),
+                                                          rospy.get_param('~cluster_bin_xy', 0.5),
+                                                          rospy.get_param('~cluster_bin_theta', math.radians(10)))),
+            # how to resample (systematic, stratified, residual or multinomial), optionally with a fixed seed,
+            # and only once the effective sample size falls below ~resample_threshold times the number of particles
+            resampler=RESAMPLERS[rospy.get_param('~resampler', 'systematic')],
+            random_state=rospy.get_param('~random_seed', None),
+            resample_threshold=rospy.get_param('~resample_threshold', 0.5),
+            # adapt the number of particles to how uncertain the filter is
+            kld_sampling=rospy.get_param('~kld_sampling', True),
+            min_particles=rospy.get_param('~min_particles', 100),
+            max_particles=rospy.get_param('~max_particles', 5000),
+            kld_epsilon=rospy.get_param('~kld_epsilon', 0.05),
+            kld_bin_size=(rospy.get_param('~kld_bin_xy', 0.5),
+                          rospy.get_param('~kld_bin_xy', 0.5),
+                          rospy.get_param('~kld_bin_theta', math.radians(10))),
+            # augmented MCL: inject random particles when the short term average of the scan likelihood falls
+            # below the long term one, so that the filter recovers when the robot is kidnapped (0 disables)
+            recovery_alpha_slow=rospy.get_param('~recovery_alpha_slow', 0.001),
+            recovery_alpha_fast=rospy.get_param('~recovery_alpha_fast', 0.1))
+
     def update_robot_pose(self):
         """ Update the estimate of the robot's pose given the updated particles.
             There are two logical methods for this:
                 (1): compute the mean pose
                 (2): compute the most likely pose (i.e. the mode of the distribution)
+            We use a bit of both: the particles are clustered, and the estimate is the mean of the
+            cluster with the most weight.
         """
-        # first make sure that the particle weights are normalized
-        self.normalize_particles()
-
-        # for the pose, calculate the particle's mean location
-    	mean_particle = Particle(0, 0, 0, 0)
-        mean_particle_theta_x = 0
-        mean_particle_theta_y = 0
-        for particle in self.particle_cloud:
-            mean_particle.x += particle.x * particle.w
-            mean_particle.y += particle.y * particle.w
-
-            # angle is calculated using trig to account for angle runover
-            distance_vector = np.sqrt(np.square(particle.y)+np.square(particle.x))
-            mean_particle_theta_x += distance_vector * np.cos(particle.theta) * particle.w
-            mean_particle_theta_y += distance_vector * np.sin(particle.theta) * particle.w
-
-        mean_particle.theta = np.arctan2(float(mean_particle_theta_y),float(mean_particle_theta_x))
-
-        self.robot_pose = mean_particle.as_pose()
+        x, y, theta = self.core.update_robot_pose()
+        self.robot_pose = Particle(x, y, theta).as_pose()
 
 
     def projected_scan_received(self, msg):
@@ -188,200 +350,309 @@ class ParticleFilter:
 
     def update_particles_with_odom(self, msg):
         """ Update the particles using the newly given odometry pose.
-            The function computes the value delta which is a tuple (x,y,theta)
-            that indicates the change in position and angle between the odometry
-            when the particles were last updated and the current odometry.
+            The change in position and angle between the odometry when the particles
+            were last updated and the current odometry is decomposed into a rotation,
+            a translation and a second rotation, which are applied to every particle
+            with noise by the motion model.
 
             msg: this is not really needed to implement this, but is here just in case.
         """
         new_odom_xy_theta = convert_pose_to_xy_and_theta(self.odom_pose.pose)
-        # compute the change in x,y,theta since our last update
-        if self.current_odom_xy_theta:
-            old_odom_xy_theta = self.current_odom_xy_theta
-            delta = (new_odom_xy_theta[0] - self.current_odom_xy_theta[0],
-                     new_odom_xy_theta[1] - self.current_odom_xy_theta[1],
-                     new_odom_xy_theta[2] - self.current_odom_xy_theta[2])
-
-            self.current_odom_xy_theta = new_odom_xy_theta
-        else:
+        if not self.current_odom_xy_theta:
             self.current_odom_xy_theta = new_odom_xy_theta
             return
-
-        odom_noise = .3 # level of noise put into particles after update from odom to introduce variability
-
-        # updates the particles based on r1, d, and r2. For more information on this, consult the website
-    	for particle in self.particle_cloud:
-            # calculates r1, d, and r2
-            r1 = np.arctan2(float(delta[1]),float(delta[0])) - old_odom_xy_theta[2]
-            d = np.sqrt(np.square(delta[0])+np.square(delta[1]))
-            r2 = delta[2] - r1
-
-            # updates the particles with the above variables, while also adding in some noise
-            particle.theta = particle.theta + r1*(random_sample()*odom_noise+(1-odom_noise/2.0))
-            particle.x = particle.x + d*np.cos(particle.theta)*(random_sample()*odom_noise+(1-odom_noise/2.0))
-            particle.y = particle.y + d*np.sin(particle.theta)*(random_sample()*odom_noise+(1-odom_noise/2.0))
-            particle.theta = particle.theta + r2*(random_sample()*odom_noise+(1-odom_noise/2.0))
-
+        old_odom_xy_theta = self.current_odom_xy_theta
+        self.current_odom_xy_theta = new_odom_xy_theta
+        self.core.update_particles_with_odom(old_odom_xy_theta, new_odom_xy_theta)
 
     def resample_particles(self):
-        """ Resample the particles according to the new particle weights.
-            The weights stored with each particle should define the probability that a particular
-            particle is selected in the resampling step.  You may want to make use of the given helper
-            function draw_random_sample.
-        """
-        # make sure the distribution is normalized
-        self.normalize_particles()
+        """ Resample the particles according to the new particle weights. """
+        self.core.resample_particles()
 
-        # creates choices and probabilities lists, which are the particles and their respective weights
-        choices = []
-        probabilities = []
-        num_samples = len(self.particle_cloud)
-        for particle in self.particle_cloud:
-            choices.append(particle)
-            probabilities.append(particle.w)
-
-        # re-makes the particle cloud according to a random sample based on the probability distribution of the weights
-        self.particle_cloud = self.draw_random_sample(choices, probabilities, num_samples)
+    def resample_if_degenerate(self):
+        """ Resample the particles only when their weights have degenerated, and log the statistics
+            of the weights (which are also kept in core.filter_stats) """
+        stats = self.core.resample_if_degenerate()
+        rospy.logdebug("N_eff: %.1f/%d, weight entropy: %.3f, resampled: %s, injected: %d",
+                       stats['n_eff'], len(self.core.particle_cloud), stats['weight_entropy'], stats['resampled'],
+                       stats['injected'])
 
     def update_particles_with_laser(self, msg):
         """ Updates the particle weights in response to the scan contained in the msg """
-
-        # for each particle, find the total error based on 36 laser measurements taken from the Neato's actual position
-        for particle in self.particle_cloud:
-            error = []
-            for theta in range(0,360,10):
-                rad = np.radians(theta)
-                err = self.occupancy_field.get_closest_obstacle_distance(particle.x + msg.ranges[theta] * np.cos(particle.theta + rad), particle.y + msg.ranges[theta] * np.sin(particle.theta + rad))
-                if (math.isnan(err)):   # if the get_closest_obstacle_distance method finds that a point is out of bounds, then the particle can't never be it
-                    particle.w = 0
-                    break
-                error.append(err**5)     # each error is appended up to a power to make more likely particles have higher probability
-            if (sum(error) == 0):     # if the particle is basically a perfect match, then we make the particle almost always enter the next iteration through resampling
-                particle.w = 1.0
-            else:
-                particle.w = 1.0/sum(error)   # the errors are inverted such that large errors become small and small errors become large
-
-
-    @staticmethod
-    def draw_random_sample(choices, probabilities, n):
-        """ Return a random sample of n elements from the set choices with the specified probabilities
-            choices: the values to sample from represented as a list
-            probabilities: the probability of selecting each element in choices represented as a list
-            n: the number of samples
-        """
-        # sets up an index list for the chosen particles, and makes bins for the probabilities
-        values = np.array(range(len(choices)))
-        probs = np.array(probabilities)
-        bins = np.add.accumulate(probs)
-        inds = values[np.digitize(random_sample(n), bins)]  # chooses the new particles based on the probabilities of the old ones
-        samples = []
-        for i in inds:
-            samples.append(deepcopy(choices[int(i)]))   # makes the new particle cloud based on the chosen particles
-        return samples
+        self.core.update_particles_with_laser(msg)
 
     def update_initial_pose(self, msg):
         """ Callback function to handle re-initializing the particle filter based on a pose estimate.
             These pose estimates could be generated by another ROS Node or could come from the rviz GUI """
+        if not(self.initialized):
+            # the map has not been loaded yet, so there is no filter to initialize
+            return
         xy_theta = convert_pose_to_xy_and_theta(msg.pose.pose)
-        self.initialize_particle_cloud(xy_theta)
-        self.fix_map_to_odom_transform(msg)
+        with self.filter_lock:
+            self.initialize_particle_cloud(xy_theta)
+            self.fix_map_to_odom_transform(msg)
+            self.particles_changed = True
+
+    def global_localization(self, req):
+        """ Service handler that re-initializes the particle filter uniformly over the free space of the map """
+        if self.initialized:
+            with self.filter_lock:
+                self.core.initialize_particle_cloud_globally()
+                self.update_robot_pose()
+                self.fix_transform_now()
+                self.particles_changed = True
+            rospy.loginfo("global localization: spread %d particles over the map", len(self.core.particle_cloud))
+        return EmptyResponse()
+
+    def switch_map(self, req):
+        """ Service handler that switches the filter to another map.  When no map is named, every map is scored
+            against the latest scan and the filter switches to the one that explains it best. """
+        if not self.initialized:
+            return SwitchMapResponse(success=False, message="the filter is not initialized yet")
+        xy_theta = convert_pose_to_xy_and_theta(req.initial_pose) if req.use_initial_pose else None
+        with self.filter_lock:
+            name = req.map
+            if not name:
+                if self.last_scan is None:
+                    return SwitchMapResponse(success=False, message="no scan has been received to pick a map with")
+                ranges, angles = self.core.beam_selector.select(self.last_scan)
+                scores = self.map_manager.score_maps(ranges, angles, n_particles=self.map_search_particles)
+                rospy.loginfo("map scores: %s", ", ".join("%s %.3g" % (s.name, s.score) for s in scores))
+                name = scores[0].name
+                if xy_theta is None:
+                    xy_theta = scores[0].xy_theta
+            elif name not in self.map_manager:
+                return SwitchMapResponse(success=False, message="unknown map %r (the maps are %s)" %
+                                         (name, ", ".join(self.map_manager.names())))
+            self.use_map(name, xy_theta)
+        rospy.loginfo("switched to map %s (%d of %d maps resident, %.1f MB)", name, len(self.map_manager.resident()),
+                      len(self.map_manager.names()), self.map_manager.memory_used()/2.0**20)
+        return SwitchMapResponse(success=True, message=name)
+
+    def use_map(self, name, xy_theta=None):
+        """ Make the filter localize in one of the maps of map_manager.  Call this with filter_lock held.
+            xy_theta: the pose to start the particles around in the new map, or None to spread them over all of it """
+        old_core = self.core
+        self.occupancy_field = self.map_manager.get(name)
+        self.core = self.make_filter_core(self.occupancy_field)
+        self.map_name = name
+        if isinstance(old_core.sensor_model, (ParallelLikelihoodModel, CoarseToFineModel)):
+            old_core.sensor_model.close()
+        if xy_theta is None:
+            self.core.initialize_particle_cloud_globally()
+            self.update_robot_pose()
+        else:
+            self.initialize_particle_cloud(xy_theta)
+        self.fix_transform_now()
+        self.particles_changed = True
+        self.map_name_pub.publish(String(data=name))
+
+    def fix_transform_now(self):
+        """ Recompute the map to odom transform right after the particles were replaced, at the time of the latest
+            scan, rather than leaving the old transform up until the robot has moved far enough for an update.
+            Before the first scan there is no transform yet, and the first scan sets it.  Call this with
+            filter_lock held. """
+        if self.last_scan is None:
+            return
+        try:
+            self.fix_map_to_odom_transform(self.last_scan)
+        except tf.Exception:
+            rospy.logwarn("could not update the map to odom transform, it is fixed on the next filter update:\n%s",
+                          traceback.format_exc())
 
     def initialize_particle_cloud(self, xy_theta=None):
         """ Initialize the particle cloud.
             Arguments
             xy_theta: a triple consisting of the mean x, y, and theta (yaw) to initialize the
                       particle cloud around.  If this input is ommitted, the odometry will be used """
-
-        # levels of noise to introduce variability
-        lin_noise = 1
-        ang_noise = math.pi/2.0
-
         #  if doesn't exist, use odom
         if xy_theta == None:
             xy_theta = convert_pose_to_xy_and_theta(self.odom_pose.pose)
 
-        # make a new particle cloud, and then create a bunch of particles at the initial location with some added noise
-        self.particle_cloud = []
-    	for x in range(self.n_particles):
-    		x = xy_theta[0] + (random_sample()*lin_noise-(lin_noise/2.0))
-    		y = xy_theta[1] + (random_sample()*lin_noise-(lin_noise/2.0))
-    		theta = xy_theta[2] + (random_sample()*ang_noise-(ang_noise/2.0))
-    		self.particle_cloud.append(Particle(x, y, theta))
-
-        # normalize particles because all weights were originall set to 1 on default
-        self.normalize_particles()
+        # make a new particle cloud of a bunch of particles at the initial location with some added noise
+        self.core.initialize_particle_cloud(xy_theta)
         self.update_robot_pose()
 
+    def publish_pose_estimate(self, stamp):
+        """ Publish the estimate of the robot's pose with its covariance (x, y and yaw, the rest are left at 0) """
+        estimate = self.core.pose_estimate
+        if estimate is None:
+            return
+        msg = PoseWithCovarianceStamped(header=Header(stamp=stamp, frame_id=self.map_frame))
+        msg.pose.pose = self.robot_pose
+        covariance = np.zeros((6, 6))
+        covariance[np.ix_((0, 1, 5), (0, 1, 5))] = estimate.covariance
+        msg.pose.covariance = covariance.ravel().tolist()
+        self.pose_pub.publish(msg)
+
     def normalize_particles(self):
         """ Make sure the particle weights define a valid distribution (i.e. sum to 1.0) """
-        # takes the sum, and then divides all weights by the sum
-    	weights_sum = sum(particle.w for particle in self.particle_cloud)
-        for particle in self.particle_cloud:
-            particle.w /= weights_sum
-
-    def publish_particles(self, msg):
-        """Publishes the particles out for visualization and other purposes"""
-        particles_conv = []
-        for p in self.particle_cloud:
-            particles_conv.append(p.as_pose())
+        self.core.normalize_particles()
+
+    def particles_to_publish(self):
+        """ Decide whether to publish the particle cloud now, and pick the particles to publish.  Nothing is
+            published when nobody is subscribed, when the cloud has not changed since it was last published,
+            or more often than ~particle_publish_rate.  Call this with filter_lock held.
+            returns: copies of the x, y and theta arrays of the particles to publish, or None """
+        if not self.particles_changed or self.particle_pub.get_num_connections() == 0:
+            return None
+        if not self.particle_publish_limiter.ready(rospy.get_time()):
+            return None
+        self.particles_changed = False
+        particles = self.core.particle_cloud
+        inds = select_particles(particles, self.max_published_particles, self.particle_output)
+        return particles.x[inds], particles.y[inds], particles.theta[inds]
+
+    def publish_particles(self, cloud):
+        """Publishes the particles out for visualization and other purposes
+           cloud: the x, y and theta arrays of the particles to publish (see particles_to_publish)"""
+        x, y, theta = cloud
+        # compute every orientation at once, and hand the messages plain floats
+        qz, qw = yaw_quaternions(theta)
+        particles_conv = [Pose(position=Point(x=px, y=py, z=0.0), orientation=Quaternion(x=0.0, y=0.0, z=pz, w=pw))
+                          for px, py, pz, pw in zip(x.tolist(), y.tolist(), qz.tolist(), qw.tolist())]
         # actually send the message so that we can view it in rviz
         self.particle_pub.publish(PoseArray(header=Header(stamp=rospy.Time.now(),
                                             frame_id=self.map_frame),
                                   poses=particles_conv))
 
     def scan_received(self, msg):
-        """ This is the default logic for what to do when processing scan data.
-            Feel free to modify this, however, I hope it will provide a good
-            guide.  The input msg is an object of type sensor_msgs/LaserScan """
+        """ Callback for new scans.  It looks up where the laser and the robot were at the time of the
+            scan, and hands the scan to the worker thread, replacing any scan that is still waiting.
+            The input msg is an object of type sensor_msgs/LaserScan """
+        instrumentation = self.instrumentation
+        instrumentation.count('scans received')
         if not(self.initialized):
             # wait for initialization to complete
+            instrumentation.count('scans skipped (not initialized)')
             return
 
         if not(self.tf_listener.canTransform(self.base_frame,msg.header.frame_id,msg.header.stamp)):
             # need to know how to transform the laser to the base frame
             # this will be given by either Gazebo or neato_node
+            instrumentation.count('scans skipped (no laser transform)')
             return
 
         if not(self.tf_listener.canTransform(self.base_frame,self.odom_frame,msg.header.stamp)):
             # need to know how to transform between base and odometric frames
             # this will eventually be published by either Gazebo or neato_node
+            instrumentation.count('scans skipped (no odom transform)')
             return
 
-        # calculate pose of laser relative ot the robot base
-        p = PoseStamped(header=Header(stamp=rospy.Time(0),
-                                      frame_id=msg.header.frame_id))
-        self.laser_pose = self.tf_listener.transformPose(self.base_frame,p)
+        with instrumentation.stage('transforms'):
+            # calculate pose of laser relative ot the robot base
+            p = PoseStamped(header=Header(stamp=rospy.Time(0),
+                                          frame_id=msg.header.frame_id))
+            laser_pose = self.tf_listener.transformPose(self.base_frame,p)
+
+            # find out where the robot thinks it is based on its odometry
+            p = PoseStamped(header=Header(stamp=msg.header.stamp,
+                                          frame_id=self.base_frame),
+                            pose=Pose())
+            odom_pose = self.tf_listener.transformPose(self.odom_frame, p)
+
+        if self.scan_queue.put((msg, laser_pose, odom_pose)):
+            # the worker was still busy with an older scan, which is now replaced by this one
+            instrumentation.count('scans dropped (superseded)')
+
+    def scan_failed(self, item, exc_info):
+        """ Called by the worker thread when processing a scan raised, which drops that scan """
+        self.instrumentation.count('scans failed')
+        rospy.logerr("failed to process a scan:\n%s", "".join(traceback.format_exception(*exc_info)))
+
+    def process_scan(self, item):
+        """ This is the default logic for what to do when processing scan data.  It runs on the
+            worker thread with the newest (scan, laser pose, odometry pose) put in the queue by scan_received. """
+        msg, self.laser_pose, self.odom_pose = item
+        instrumentation = self.instrumentation
+
+        # how far behind the scan we are by the time we get to process it
+        lag = (rospy.Time.now() - msg.header.stamp).to_sec()
+        # the lag is recorded before stale scans are dropped, or the percentiles would leave the worst out
+        instrumentation.record_lag(lag)
+        if self.max_scan_age and lag > self.max_scan_age:
+            instrumentation.count('scans dropped (stale)')
+            return
 
-        # find out where the robot thinks it is based on its odometry
-        p = PoseStamped(header=Header(stamp=msg.header.stamp,
-                                      frame_id=self.base_frame),
-                        pose=Pose())
-        self.odom_pose = self.tf_listener.transformPose(self.odom_frame, p)
+        with self.filter_lock:
+            self.last_scan = msg
+            if self.update_filter(msg):
+                self.particles_changed = True
+            self.publish_pose_estimate(msg.header.stamp)
+            cloud = self.particles_to_publish()
+        # publish particles (so things like rviz can see them)
+        if cloud is not None:
+            with instrumentation.stage('publish'):
+                self.publish_particles(cloud)
+
+    def update_filter(self, msg):
+        """ Update the particle filter with a scan, if the robot has moved far enough since the last update
+            returns: True if the particles were initialized or updated """
+        instrumentation = self.instrumentation
         # store the the odometry pose in a more convenient format (x,y,theta)
         new_odom_xy_theta = convert_pose_to_xy_and_theta(self.odom_pose.pose)
-        if not(self.particle_cloud):
-            # now that we have all of the necessary transforms we can update the particle cloud
-            self.initialize_particle_cloud()
+        if not(self.core.particle_cloud) or not(self.current_odom_xy_theta):
+            # now that we have all of the necessary transforms we can update the particle cloud, unless the
+            # particles were already placed (by initialpose or a service) before the first scan came in
+            if not(self.core.particle_cloud):
+                if self.start_global:
+                    self.core.initialize_particle_cloud_globally()
+                    self.update_robot_pose()
+                else:
+                    self.initialize_particle_cloud()
             # cache the last odometric pose so we can only update our particle filter if we move more than self.d_thresh or self.a_thresh
             self.current_odom_xy_theta = new_odom_xy_theta
             # update our map to odom transform now that the particles are initialized
             self.fix_map_to_odom_transform(msg)
+            return True
         elif (math.fabs(new_odom_xy_theta[0] - self.current_odom_xy_theta[0]) > self.d_thresh or
               math.fabs(new_odom_xy_theta[1] - self.current_odom_xy_theta[1]) > self.d_thresh or
               math.fabs(new_odom_xy_theta[2] - self.current_odom_xy_theta[2]) > self.a_thresh):
             # we have moved far enough to do an update!
-            self.update_particles_with_odom(msg)    # update based on odometry
+            with instrumentation.stage('odom'):
+                self.update_particles_with_odom(msg)    # update based on odometry
             if self.last_projected_stable_scan:
                 last_projected_scan_timeshift = deepcopy(self.last_projected_stable_scan)
                 last_projected_scan_timeshift.header.stamp = msg.header.stamp
                 self.scan_in_base_link = self.tf_listener.transformPointCloud("base_link", last_projected_scan_timeshift)
 
-            self.update_particles_with_laser(msg)   # update based on laser scan
-            self.update_robot_pose()                # update robot's pose
-            self.resample_particles()               # resample particles to focus on areas of high density
-            self.fix_map_to_odom_transform(msg)     # update map to odom transform now that we have new particles
-        # publish particles (so things like rviz can see them)
-        self.publish_particles(msg)
+            with instrumentation.stage('laser'):
+                self.update_particles_with_laser(msg)   # update based on laser scan
+            with instrumentation.stage('pose'):
+                self.update_robot_pose()                # update robot's pose
+            with instrumentation.stage('resample'):
+                self.resample_if_degenerate()           # resample particles to focus on areas of high density
+            with instrumentation.stage('tf fixup'):
+                self.fix_map_to_odom_transform(msg)     # update map to odom transform now that we have new particles
+            instrumentation.count('scans processed')
+            return True
+        else:
+            instrumentation.count('scans skipped (not moved)')
+            return False
+
+    def publish_diagnostics(self):
+        """ Publish the instrumentation of scan_received and the statistics of the filter on /diagnostics,
+            at most once every diagnostics_period """
+        now = rospy.get_rostime()
+        if now - self.last_diagnostics_time < self.diagnostics_period:
+            return
+        self.last_diagnostics_time = now
+
+        values = self.instrumentation.summary()
+        if self.initialized:
+            values.append(('particles', len(self.core.particle_cloud)))
+            values.append(('map', self.map_name))
+            values.append(('resident maps', len(self.map_manager.resident())))
+            values.extend(sorted(self.core.filter_stats.items()))
+        status = DiagnosticStatus(name=rospy.get_name() + ": particle filter", hardware_id=self.map_frame,
+                                  values=[KeyValue(key=key, value=str(value)) for key, value in values])
+        if self.instrumentation.queue_lag.percentile(0.95) > self.max_queue_lag:
+            status.level = DiagnosticStatus.WARN
+            status.message = "falling behind the scan rate"
+        else:
+            status.level = DiagnosticStatus.OK
+            status.message = "ok"
+        self.diagnostics_pub.publish(DiagnosticArray(header=Header(stamp=now), status=[status]))
 
     def fix_map_to_odom_transform(self, msg):
         """ This method constantly updates the offset of the map and
@@ -392,16 +663,19 @@ class ParticleFilter:
                         header=Header(stamp=msg.header.stamp,frame_id=self.base_frame))
         self.tf_listener.waitForTransform(self.base_frame, self.odom_frame, msg.header.stamp, rospy.Duration(1.0))
         self.odom_to_map = self.tf_listener.transformPose(self.odom_frame, p)
-        (self.translation, self.rotation) = convert_pose_inverse_transform(self.odom_to_map.pose)
+        with self.transform_lock:
+            (self.translation, self.rotation) = convert_pose_inverse_transform(self.odom_to_map.pose)
 
     def broadcast_last_transform(self):
         """ Make sure that we are always broadcasting the last map
             to odom transformation.  This is necessary so things like
             move_base can work properly. """
-        if not(hasattr(self,'translation') and hasattr(self,'rotation')):
-            return
-        self.tf_broadcaster.sendTransform(self.translation,
-                                          self.rotation,
+        with self.transform_lock:
+            if not(hasattr(self,'translation') and hasattr(self,'rotation')):
+                return
+            translation, rotation = self.translation, self.rotation
+        self.tf_broadcaster.sendTransform(translation,
+                                          rotation,
                                           rospy.get_rostime(),
                                           self.odom_frame,
                                           self.map_frame)
@@ -413,4 +687,5 @@ if __name__ == '__main__':
     while not(rospy.is_shutdown()):
         # in the main loop all we do is continuously broadcast the latest map to odom transform
         n.broadcast_last_transform()
+        n.publish_diagnostics()
         r.sleep()
@@ -0,0 +1,148 @@
+""" Pose estimation from the particle cloud by clustering.  The particles are hashed into (x, y, theta)
+    bins, neighbouring occupied bins are joined into clusters, and the estimate is the weighted mean
+    and covariance of the cluster holding the most weight.  Unlike the weighted mean of the whole
+    cloud, the estimate of a multi-modal cloud lands on one of the modes instead of between them.
+
+    Every step is linear in the number of particles: the bins are slots of a dense array over the
+    bounding box of the cloud (the bins are coarsened if the cloud is so spread out that the box
+    would be much larger than the number of particles), and the clusters are the connected
+    components of the graph of neighbouring bins. """
+
+import math
+
+import numpy as np
+
+from motion_model import angle_normalize
+
+# the offsets of half of the 26 neighbours of a bin in (x, y, theta).  Every pair of neighbouring bins
+# is found once, from the bin that comes first.
+_NEIGHBOUR_OFFSETS = np.array([(dx, dy, dt) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dt in (-1, 0, 1)
+                               if (dx, dy, dt) > (0, 0, 0)], dtype=np.int64)
+
+
+def connected_components(n, a, b):
+    """ Label the connected components of a graph
+        n: the number of nodes
+        a, b: arrays of the two ends of every edge
+        returns: an array of the label of each node, which is the smallest node in its component """
+    labels = np.arange(n)
+    while True:
+        label_a = labels[a]
+        label_b = labels[b]
+        joined = label_a != label_b
+        if not np.any(joined):
+            return labels
+        # hook the larger root of every edge that joins two components onto the smaller one, then point every
+        # node directly at its root again
+        np.minimum.at(labels, np.maximum(label_a, label_b)[joined], np.minimum(label_a, label_b)[joined])
+        while True:
+            roots = labels[labels]
+            if np.array_equal(roots, labels):
+                break
+            labels = roots
+
+
+class PoseEstimate(object):
+    """ The estimate of the robot's pose
+        Attributes:
+            xy_theta: the estimated pose as a (x, y, theta) triple
+            covariance: the 3x3 covariance of (x, y, theta) of the particles in the chosen cluster
+            weight: the fraction of the total weight in the chosen cluster
+            n_clusters: the number of clusters the particles formed
+    """
+
+    def __init__(self, xy_theta, covariance, weight=1.0, n_clusters=1):
+        self.xy_theta = xy_theta
+        self.covariance = covariance
+        self.weight = weight
+        self.n_clusters = n_clusters
+
+
+class ClusterPoseEstimator(object):
+    """ Estimates the robot's pose as the mean of the heaviest cluster of particles
+        Attributes:
+            bin_size: the (x, y, theta) widths of the bins that are joined into clusters.  Particles end up
+                      in the same cluster when a chain of occupied neighbouring bins connects them.
+            max_cells_per_particle: the most bins in the bounding box of the cloud per particle, before the
+                                    x and y bins are coarsened to keep the work linear in the particles
+    """
+
+    def __init__(self, bin_size=(0.5, 0.5, math.radians(10)), max_cells_per_particle=8):
+        self.bin_size = bin_size
+        self.max_cells_per_particle = max_cells_per_particle
+
+    def cluster(self, x, y, theta):
+        """ Group the particles into clusters
+            returns: an array of the cluster label of each particle (labels are 0 to n_clusters - 1)
+                     and the number of clusters """
+        n = len(x)
+        n_theta = max(1, int(round(2*math.pi/self.bin_size[2])))
+        bin_t = np.floor(np.mod(theta, 2*math.pi)*(n_theta/(2*math.pi))).astype(np.int64) % n_theta
+
+        # the bins of the bounding box of the cloud, coarsened until there are not too many of them
+        max_cells = max(self.max_cells_per_particle*n, 1 << 16)
+        bin_x_size, bin_y_size = self.bin_size[0], self.bin_size[1]
+        while True:
+            bin_x = np.floor(x/bin_x_size).astype(np.int64)
+            bin_y = np.floor(y/bin_y_size).astype(np.int64)
+            bin_x -= bin_x.min()
+            bin_y -= bin_y.min()
+            n_x = int(bin_x.max()) + 1
+            n_y = int(bin_y.max()) + 1
+            if n_x*n_y*n_theta <= max_cells:
+                break
+            bin_x_size *= 2
+            bin_y_size *= 2
+        cells = (bin_x*n_y + bin_y)*n_theta + bin_t
+
+        # the occupied bins, and which bin each particle is in
+        counts = np.bincount(cells, minlength=n_x*n_y*n_theta)
+        occupied = np.flatnonzero(counts)
+        slot = np.full(len(counts), -1, dtype=np.int64)
+        slot[occupied] = np.arange(len(occupied))
+        particle_bins = slot[cells]
+
+        # join every pair of occupied neighbouring bins, looking up all of the neighbours at once
+        occ_t = occupied % n_theta
+        occ_y = (occupied//n_theta) % n_y
+        occ_x = occupied//(n_theta*n_y)
+        nx = occ_x + _NEIGHBOUR_OFFSETS[:, 0:1]
+        ny = occ_y + _NEIGHBOUR_OFFSETS[:, 1:2]
+        nt = (occ_t + _NEIGHBOUR_OFFSETS[:, 2:3]) % n_theta
+        inside = (nx >= 0) & (nx < n_x) & (ny >= 0) & (ny < n_y)
+        neighbours = np.full(nx.shape, -1, dtype=np.int64)
+        neighbours[inside] = slot[(nx[inside]*n_y + ny[inside])*n_theta + nt[inside]]
+        found = neighbours >= 0
+        bin_labels = connected_components(len(occupied), np.nonzero(found)[1], neighbours[found])
+
+        # number the clusters from 0, in the order of their roots
+        is_root = bin_labels == np.arange(len(occupied))
+        cluster_of_root = np.cumsum(is_root) - 1
+        return cluster_of_root[bin_labels][particle_bins], int(np.sum(is_root))
+
+    def estimate(self, particles):
+        """ Estimate the robot's pose from a ParticleSet with normalized weights
+            returns: a PoseEstimate of the heaviest cluster """
+        labels, n_clusters = self.cluster(particles.x, particles.y, particles.theta)
+        cluster_weights = np.bincount(labels, weights=particles.w, minlength=n_clusters)
+        best = int(np.argmax(cluster_weights))
+        members = labels == best
+        x = particles.x[members]
+        y = particles.y[members]
+        theta = particles.theta[members]
+        w = particles.w[members]
+        total = np.sum(w)
+        if total > 0:
+            w = w/total
+        else:
+            w = np.full(len(w), 1.0/len(w))
+
+        mean_x = np.dot(w, x)
+        mean_y = np.dot(w, y)
+        mean_theta = math.atan2(np.dot(w, np.sin(theta)), np.dot(w, np.cos(theta)))
+
+        # the covariance of the cluster, with the headings measured from the (circular) mean heading
+        deviations = np.vstack((x - mean_x, y - mean_y, angle_normalize(theta - mean_theta)))
+        covariance = np.dot(deviations*w, deviations.T)
+        return PoseEstimate((float(mean_x), float(mean_y), mean_theta), covariance,
+                            weight=float(cluster_weights[best]/np.sum(cluster_weights)), n_clusters=n_clusters)
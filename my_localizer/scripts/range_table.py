@@ -0,0 +1,84 @@
+""" A precomputed table of the range a beam cast from each free cell of a map would measure, for a
+    fixed set of headings.  Building the table casts a ray per (free cell, heading) pair once per map,
+    and the table is cached to disk next to the distance field.  At run time the expected range of
+    every beam of every particle is a single array lookup. """
+
+import math
+
+import numpy as np
+
+import field_cache
+from raycast import cast_rays
+
+# the value stored for rays that do not hit anything within max_range
+NO_HIT = np.iinfo(np.uint16).max
+
+
+class RangeTable(object):
+    """ The expected ranges of beams cast from the free cells of a map
+        Attributes:
+            occupancy_field: the OccupancyField the rays are cast through
+            n_headings: the number of headings, evenly spaced over a full circle starting at 0
+            max_range: rays that travel further than this (in meters) without a hit are stored as NO_HIT
+            cell_rows: a (height, width) array of the row of the table of every free cell, -1 for other cells
+            table: an (n_free_cells, n_headings) uint16 array of the range of each ray in map cells
+                   (rounded to the nearest cell), or NO_HIT.  This is a read-only memory map of the cache
+                   file when the occupancy field has a cache directory.
+    """
+
+    def __init__(self, occupancy_field, n_headings=72, max_range=5.0, chunk_size=4096):
+        """ chunk_size: how many cells to cast rays from at a time while building the table """
+        self.occupancy_field = occupancy_field
+        self.n_headings = n_headings
+        self.max_range = max_range
+        info = occupancy_field.map.info
+        free_cells = occupancy_field.free_cells
+        if max_range/info.resolution >= NO_HIT:
+            raise ValueError("max_range %.1f m does not fit in the table at a resolution of %g m" %
+                             (max_range, info.resolution))
+
+        self.cell_rows = np.full((info.height, info.width), -1, dtype=np.int32)
+        self.cell_rows.ravel()[free_cells] = np.arange(len(free_cells), dtype=np.int32)
+
+        def compute_table():
+            headings = np.arange(n_headings)*(2*math.pi/n_headings)
+            table = np.empty((len(free_cells), n_headings), dtype=np.uint16)
+            for start in range(0, len(free_cells), chunk_size):
+                # cast from the center of each cell
+                rows, cols = np.divmod(free_cells[start:start + chunk_size], info.width)
+                x = info.origin.position.x + (cols + 0.5)*info.resolution
+                y = info.origin.position.y + (rows + 0.5)*info.resolution
+                ranges = cast_rays(occupancy_field, x[:, np.newaxis], y[:, np.newaxis], headings, max_range)
+                cells = np.round(ranges/info.resolution)
+                cells[~np.isfinite(cells)] = NO_HIT
+                table[start:start + chunk_size] = cells
+            return table
+
+        name = "range_table_%dh_%dmm" % (n_headings, int(round(max_range*1000)))
+        self.table = field_cache.load_cached_array(occupancy_field.cache_dir, name, occupancy_field.cache_key,
+                                                   compute_table)
+
+    def expected_ranges(self, x, y, headings):
+        """ Look up the range a beam would measure from each pose
+            x, y: arrays of the N positions in the map frame
+            headings: an (N, B) array of the beam headings in the map frame, which are rounded to the
+                      nearest heading of the table
+            returns: an (N, B) array of expected ranges in meters, max_range for beams that would not hit
+                     anything, and nan for the positions that are not in a free cell """
+        info = self.occupancy_field.map.info
+        col = np.floor((np.asarray(x) - info.origin.position.x)/info.resolution)
+        row = np.floor((np.asarray(y) - info.origin.position.y)/info.resolution)
+        in_bounds = (col >= 0) & (col < info.width) & (row >= 0) & (row < info.height)
+        table_rows = np.full(col.shape, -1, dtype=np.intp)
+        table_rows[in_bounds] = self.cell_rows[row[in_bounds].astype(np.intp), col[in_bounds].astype(np.intp)]
+        in_free_cell = table_rows >= 0
+
+        heading_bins = np.floor(np.asarray(headings)*(self.n_headings/(2*math.pi)) + 0.5).astype(np.intp)
+        heading_bins %= self.n_headings
+        # gather through flat indices, which is faster than indexing the table with two index arrays
+        cells = np.take(self.table.ravel(), np.maximum(table_rows, 0)[:, np.newaxis]*self.n_headings + heading_bins)
+
+        ranges = cells*info.resolution
+        ranges[cells == NO_HIT] = self.max_range
+        ranges[~in_free_cell] = np.nan
+        return ranges
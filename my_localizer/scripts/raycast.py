@@ -0,0 +1,43 @@
+""" Casts rays through an OccupancyField to find the range at which each one hits an obstacle.  The
+    rays are marched with sphere tracing: every step advances a ray by (just under) the distance to
+    the closest obstacle, which the occupancy field already stores, so a ray crosses open space in a
+    handful of steps and all of the rays are advanced together as arrays. """
+
+import numpy as np
+
+
+def cast_rays(occupancy_field, x, y, angles, max_range, max_steps=500):
+    """ Find the range at which rays starting at (x, y) with the given headings hit an obstacle
+        occupancy_field: the OccupancyField to cast the rays through
+        x, y, angles: arrays (which are broadcast against each other) of the ray origins and headings
+                      in the map frame
+        max_range: rays that travel further than this (in meters) without a hit return inf
+        returns: an array of ranges, with inf for rays that leave the map or reach max_range without a hit """
+    x, y, angles = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+                                       np.asarray(angles, dtype=np.float64))
+    resolution = occupancy_field.map.info.resolution
+    cos_angle = np.cos(angles).ravel()
+    sin_angle = np.sin(angles).ravel()
+    x0 = x.ravel()
+    y0 = y.ravel()
+
+    ranges = np.zeros(x0.shape)
+    hit = np.zeros(x0.shape, dtype=bool)
+    active = np.arange(x0.shape[0])
+    for _ in range(max_steps):
+        if not len(active):
+            break
+        r = ranges[active]
+        distance = occupancy_field.get_closest_obstacle_distance(x0[active] + r*cos_angle[active],
+                                                                 y0[active] + r*sin_angle[active])
+        # the stored distances are between cell centers, so back off by a cell to never step over an
+        # obstacle, but always advance by at least half a cell
+        reached = distance == 0
+        hit[active[reached]] = True
+        r = r + np.maximum(distance - resolution, 0.5*resolution)
+        still_going = ~reached & ~np.isnan(distance) & (r <= max_range)
+        active = active[still_going]
+        ranges[active] = r[still_going]
+
+    ranges[~hit] = np.inf
+    return ranges.reshape(x.shape)
@@ -0,0 +1,115 @@
+""" Resamplers for the particle filter.  Each resampler takes an array of normalized weights and
+    returns an array of the indices of the particles that survive, in ascending order, so the new
+    particle cloud can be made with a single gather (see ParticleSet.gather) instead of copying
+    particle objects one at a time.
+
+    Every resampler accepts a random_state, which may be None (use the global numpy random state),
+    an integer seed, or a numpy.random.RandomState, so that resampling can be made reproducible. """
+
+import numpy as np
+
+
+def get_random_state(random_state=None):
+    """ Turn a seed, a RandomState or None into something that can draw random numbers """
+    if random_state is None:
+        return np.random
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+    return np.random.RandomState(random_state)
+
+
+def _cumulative_weights(weights):
+    """ The cumulative sum of the weights, with the last entry forced to exactly 1.0 so that rounding
+        errors can never leave a sample position past the end """
+    cumulative = np.cumsum(weights, dtype=np.float64)
+    cumulative /= cumulative[-1]
+    cumulative[-1] = 1.0
+    return cumulative
+
+
+def _stratified_indices(cumulative, offsets):
+    """ Map the sample positions (k + offsets[k])/n for k = 0..n-1 onto particle indices in O(N + n).
+        Position k lies in the stratum [k/n, (k+1)/n), so the number of positions below a cumulative
+        weight c is floor(n*c) plus one if the position in the stratum containing c is below c. """
+    n = offsets.shape[0]
+    scaled = n*cumulative
+    stratum = np.minimum(np.floor(scaled).astype(np.intp), n)
+    in_range = stratum < n
+    below = stratum.copy()
+    below[in_range] += offsets[stratum[in_range]] < scaled[in_range] - stratum[in_range]
+    counts = np.diff(np.concatenate(([0], below)))
+    return np.repeat(np.arange(cumulative.shape[0]), counts)
+
+
+def systematic_resample(weights, n=None, random_state=None):
+    """ Low-variance (systematic) resampling: a single random offset shared by n evenly spaced positions
+        weights: the normalized particle weights
+        n: the number of samples to draw (defaults to the number of particles)
+        returns: an array of n particle indices """
+    n = len(weights) if n is None else n
+    offsets = np.empty(n)
+    offsets.fill(get_random_state(random_state).random_sample())
+    return _stratified_indices(_cumulative_weights(weights), offsets)
+
+
+def stratified_resample(weights, n=None, random_state=None):
+    """ Stratified resampling: one independent random position in each of n equal strata
+        weights: the normalized particle weights
+        n: the number of samples to draw (defaults to the number of particles)
+        returns: an array of n particle indices """
+    n = len(weights) if n is None else n
+    offsets = get_random_state(random_state).random_sample(n)
+    return _stratified_indices(_cumulative_weights(weights), offsets)
+
+
+def residual_resample(weights, n=None, random_state=None):
+    """ Residual resampling: each particle is first copied floor(n*w) times, and the remaining samples
+        are drawn systematically from the leftover weights
+        weights: the normalized particle weights
+        n: the number of samples to draw (defaults to the number of particles)
+        returns: an array of n particle indices """
+    n = len(weights) if n is None else n
+    expected = n*np.asarray(weights, dtype=np.float64)/np.sum(weights)
+    copies = np.floor(expected).astype(np.intp)
+    n_residual = n - int(np.sum(copies))
+    if n_residual > 0:
+        residuals = expected - copies
+        copies += np.bincount(systematic_resample(residuals, n_residual, random_state),
+                              minlength=copies.shape[0])
+    return np.repeat(np.arange(copies.shape[0]), copies)
+
+
+def multinomial_resample(weights, n=None, random_state=None):
+    """ Multinomial resampling: n independent draws from the weights.  This has the highest variance
+        of the resamplers and runs in O(n log N).
+        weights: the normalized particle weights
+        n: the number of samples to draw (defaults to the number of particles)
+        returns: an array of n particle indices """
+    n = len(weights) if n is None else n
+    positions = np.sort(get_random_state(random_state).random_sample(n))
+    return np.searchsorted(_cumulative_weights(weights), positions, side='right')
+
+
+def effective_sample_size(weights):
+    """ The effective number of particles N_eff = 1/sum(w**2) of the normalized weights.  It is N when
+        the weights are uniform and falls to 1 as all of the weight collapses onto a single particle. """
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = weights/np.sum(weights)
+    return 1.0/np.dot(weights, weights)
+
+
+def weight_entropy(weights):
+    """ The entropy (in nats) of the normalized weights.  It is log(N) when the weights are uniform
+        and 0 when all of the weight is on a single particle. """
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = weights/np.sum(weights)
+    nonzero = weights[weights > 0]
+    return float(-np.dot(nonzero, np.log(nonzero)))
+
+
+RESAMPLERS = {
+    'systematic': systematic_resample,
+    'stratified': stratified_resample,
+    'residual': residual_resample,
+    'multinomial': multinomial_resample,
+}
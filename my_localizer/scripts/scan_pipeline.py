@@ -0,0 +1,89 @@
+""" Decouples scan processing from the thread that receives the scans.  The receiving side puts each
+    new scan (together with the odometry at the time of the scan) into a LatestOnlyQueue, which only
+    ever holds the newest item, and a ScanWorker thread runs the filter update on it.  When an update
+    takes longer than the scan period the scans that arrived in the meantime are dropped instead of
+    piling up, so the estimate never falls more than one update behind. """
+
+import sys
+import threading
+import traceback
+
+
+class LatestOnlyQueue(object):
+    """ A queue that holds at most one item: putting a new item replaces (drops) the pending one
+        Attributes:
+            dropped: the number of items that were replaced before anyone got them
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._has_item = False
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        """ Make item the pending item
+            returns: True if this replaced an item that was never taken """
+        with self._condition:
+            replaced = self._has_item
+            if replaced:
+                self.dropped += 1
+            self._item = item
+            self._has_item = True
+            self._condition.notify()
+            return replaced
+
+    def get(self, timeout=None):
+        """ Wait for and take the pending item
+            returns: the item, or None if the timeout expired or the queue was closed """
+        with self._condition:
+            if not self._has_item and not self._closed:
+                self._condition.wait(timeout)
+            if not self._has_item:
+                return None
+            item = self._item
+            self._item = None
+            self._has_item = False
+            return item
+
+    def close(self):
+        """ Wake up anyone waiting in get, and make later gets return immediately """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class ScanWorker(threading.Thread):
+    """ A daemon thread that takes items off a LatestOnlyQueue and processes them one at a time
+        Attributes:
+            queue: the LatestOnlyQueue to take items from
+            process: the function called with each item
+            should_stop: a function of no arguments that returns True when the worker should exit
+            on_error: a function called as on_error(item, exc_info) when processing an item raises.  The worker
+                      carries on with the next item either way.  By default the traceback is printed to stderr.
+    """
+
+    def __init__(self, queue, process, should_stop, poll_period=0.1, on_error=None):
+        threading.Thread.__init__(self, name="scan_worker")
+        self.daemon = True
+        self.queue = queue
+        self.process = process
+        self.should_stop = should_stop
+        self.poll_period = poll_period
+        self.on_error = on_error
+
+    def run(self):
+        while not self.should_stop():
+            item = self.queue.get(self.poll_period)
+            if item is None:
+                continue
+            try:
+                self.process(item)
+            except Exception:
+                # a failed item (e.g. a transform that could not be looked up) must not kill the thread, or
+                # nothing would ever be processed again
+                if self.on_error is not None:
+                    self.on_error(item, sys.exc_info())
+                else:
+                    traceback.print_exc()
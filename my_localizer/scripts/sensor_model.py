@@ -0,0 +1,245 @@
+""" Laser measurement models that score every particle against every beam of a scan in a single
+    array operation """
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+class LikelihoodFieldModel(object):
+    """ Scores particles by projecting every beam endpoint of every particle into the map and looking
+        up the distance from each endpoint to the closest obstacle in the occupancy field
+        Attributes:
+            occupancy_field: the OccupancyField to look the endpoints up in
+            error_power: the power each endpoint distance is raised to before summing.  Higher powers
+                         make the more accurate particles much more likely than the rest.
+    """
+
+    def __init__(self, occupancy_field, error_power=5):
+        self.occupancy_field = occupancy_field
+        self.error_power = error_power
+
+    def endpoints(self, x, y, theta, ranges, angles):
+        """ Compute where each beam of each particle ends in the map frame
+            x, y, theta: arrays of the N particle poses in the map frame
+            ranges, angles: the measured range and the bearing (relative to the robot heading) of each
+                            beam, each either as an array of B beams shared by every particle or as an
+                            (N, B) array
+            returns: the x and y coordinates of the endpoints as two (N, B) arrays """
+        ranges = np.asarray(ranges, dtype=np.float64)
+        angles = np.asarray(angles, dtype=np.float64)
+        x = np.asarray(x)[:, np.newaxis]
+        y = np.asarray(y)[:, np.newaxis]
+        theta = np.asarray(theta)[:, np.newaxis]
+        if angles.ndim == 1:
+            # expand cos(theta + angle) and sin(theta + angle) so that only N + B trig calls are needed
+            cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+            cos_angle, sin_angle = np.cos(angles), np.sin(angles)
+            cos_beam = cos_theta*cos_angle - sin_theta*sin_angle
+            sin_beam = sin_theta*cos_angle + cos_theta*sin_angle
+        else:
+            cos_beam = np.cos(theta + angles)
+            sin_beam = np.sin(theta + angles)
+        return x + ranges*cos_beam, y + ranges*sin_beam
+
+    def endpoint_distances(self, x, y, theta, ranges, angles):
+        """ Compute the distance from each beam endpoint to the closest obstacle (see endpoints for the arguments)
+            returns: an (N, B) array of distances, which is nan for endpoints outside of the map """
+        return self.occupancy_field.get_closest_obstacle_distance(*self.endpoints(x, y, theta, ranges, angles))
+
+    def weights(self, x, y, theta, ranges, angles, valid=None):
+        """ Compute the (unnormalized) weight of each particle given a scan
+            x, y, theta: arrays of the N particle poses in the map frame
+            ranges, angles: the beams to score (see endpoint_distances).  Beams that are not finite or
+                            not positive should be removed beforehand (see valid_beams).
+            valid: if given, an (N, B) boolean array of the beams each particle is scored with.  The other
+                   beams are padding (e.g. when the particles of several scans are scored together, see
+                   multi_robot.py) and count for nothing, so their ranges only need to be finite.
+            returns: an array of N weights.  A particle with any endpoint outside of the map gets a
+                     weight of 0, and a particle that matches the scan perfectly gets a weight of 1. """
+        distances = self.endpoint_distances(x, y, theta, ranges, angles)
+        if valid is not None:
+            distances = np.where(valid, distances, 0.0)
+        return self.weights_from_errors(self.errors_from_distances(distances))
+
+    def errors_from_distances(self, distances):
+        """ Compute the error of each particle from the (N, B) distances of its beam endpoints to the
+            closest obstacles.  Lower errors are better, and the error is nan for particles with endpoints
+            outside of the map. """
+        # each error is raised to a power to make more likely particles have higher probability.  An
+        # endpoint outside of the map makes the sum nan, since the particle can't ever be there
+        return np.sum(np.power(distances, self.error_power), axis=1)
+
+    def weights_from_errors(self, error):
+        """ Compute the weight of each particle from its error (see errors_from_distances) """
+        # the errors are inverted such that large errors become small and small errors become large
+        weights = np.ones(error.shape)
+        np.divide(1.0, error, out=weights, where=error > 0)
+        weights[np.isnan(error)] = 0.0
+        return weights
+
+
+class CoarseToFineModel(object):
+    """ Scores large particle sets coarse to fine on a DistanceFieldPyramid.  Every particle is scored on
+        the coarsest level with a subset of the beams, only the best keep_fraction of them are scored again
+        on the next level with more beams, and so on until the survivors are scored with every beam on the
+        full resolution field.  Coarse distances never exceed the true distances and every error term is
+        positive, so the coarse errors are lower bounds on the full resolution errors.  The pruned particles
+        get a weight of 0.
+        Attributes:
+            sensor_model: the LikelihoodFieldModel that computes the endpoints and the errors from distances
+            pyramid: the DistanceFieldPyramid of the sensor model's occupancy field
+            keep_fraction: the fraction of the particles that survives each coarse level
+            beam_stride: each level uses every beam_stride-th beam of the beams used by the next finer level
+            min_particles: pruning stops once this few particles are left, so sets of up to this many
+                           particles are scored exactly like with the sensor model alone
+            workers: the number of threads that score the particles of each level.  Every particle's error on a
+                     level only depends on that particle, so the particles are split between the threads level
+                     by level, and the pruning still ranks all of them together.  (Wrapping the whole model in
+                     a ParallelLikelihoodModel would prune every shard on its own.)
+            min_shard: levels with fewer than workers*min_shard particles are split into fewer shards
+    """
+
+    def __init__(self, sensor_model, pyramid, keep_fraction=0.25, beam_stride=2, min_particles=1000,
+                 workers=1, min_shard=2048):
+        self.sensor_model = sensor_model
+        self.pyramid = pyramid
+        self.keep_fraction = keep_fraction
+        self.beam_stride = beam_stride
+        self.min_particles = min_particles
+        self.workers = workers
+        self.min_shard = min_shard
+        self._pool = ThreadPool(workers) if workers > 1 else None
+
+    def weights(self, x, y, theta, ranges, angles, valid=None):
+        """ Compute the (unnormalized) weight of each particle given a scan (see LikelihoodFieldModel.weights) """
+        x, y, theta = np.asarray(x), np.asarray(y), np.asarray(theta)
+        ranges, angles = np.asarray(ranges), np.asarray(angles)
+
+        def level_errors(level, survivors, stride):
+            level_ranges = ranges[..., ::stride]
+            level_angles = angles[..., ::stride]
+            if ranges.ndim == 2:
+                level_ranges = level_ranges[survivors]
+            if angles.ndim == 2:
+                level_angles = level_angles[survivors]
+            end_x, end_y = self.sensor_model.endpoints(x[survivors], y[survivors], theta[survivors],
+                                                       level_ranges, level_angles)
+            distances = level.get_closest_obstacle_distance(end_x, end_y)
+            if valid is not None:
+                distances = np.where(valid[survivors, ::stride], distances, 0.0)
+            return self.sensor_model.errors_from_distances(distances)
+
+        def sharded_level_errors(level, survivors, stride):
+            n_shards = int(min(self.workers, max(1, len(survivors)//self.min_shard)))
+            if n_shards == 1:
+                return level_errors(level, survivors, stride)
+            bounds = np.linspace(0, len(survivors), n_shards + 1).astype(np.intp)
+            return np.concatenate(self._pool.map(lambda shard: level_errors(level, shard, stride),
+                                                 [survivors[start:end] for start, end in zip(bounds[:-1], bounds[1:])]))
+
+        survivors = np.arange(len(x))
+        coarse_levels = self.pyramid.coarse_levels()
+        for i, level in enumerate(coarse_levels):
+            keep = max(self.min_particles, int(np.ceil(self.keep_fraction*len(survivors))))
+            if keep >= len(survivors):
+                break
+            lower_bounds = sharded_level_errors(level, survivors, self.beam_stride**(len(coarse_levels) - i))
+            # particles with endpoints outside of the map are the worst.  argpartition picks the best particles
+            # in linear time, without sorting them.
+            lower_bounds[np.isnan(lower_bounds)] = np.inf
+            survivors = survivors[np.argpartition(lower_bounds, keep - 1)[:keep]]
+
+        weights = np.zeros(len(x))
+        error = sharded_level_errors(self.pyramid.levels[0], survivors, 1)
+        weights[survivors] = self.sensor_model.weights_from_errors(error)
+        return weights
+
+    def close(self):
+        """ Shut the thread pool down, if there is one """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+
+class BeamRangeModel(object):
+    """ Scores particles with the beam model: each measured range is compared to the range the beam would
+        measure from the particle's pose (looked up in a RangeTable, so occlusions are accounted for), under
+        a mixture of a gaussian around the expected range, an exponential for unexpected obstacles in front
+        of it, a spike at the maximum range and a uniform floor for random readings.
+        Attributes:
+            range_table: the RangeTable of expected ranges
+            z_hit, z_short, z_max, z_rand: the mixing weights of the four parts of the mixture
+            sigma_hit: the standard deviation (meters) of the measurement noise around the expected range
+            lambda_short: the rate (1/meters) of the exponential distribution of unexpected obstacles
+            independent_beams: how many independent beams a scan counts as.  The beams of a scan are far from
+                               independent, and the plain product of their probabilities over- or underflows
+                               with a few hundred beams, so the log-likelihood of a scan of B beams is scaled by
+                               independent_beams/B.  The weights then stay absolute (comparable between scans,
+                               as augmented MCL needs) and within the floating point range.  With None the plain
+                               product is used, relative to the most likely particle of each scan.
+    """
+
+    def __init__(self, range_table, z_hit=0.95, z_short=0.1, z_max=0.05, z_rand=0.05, sigma_hit=0.2,
+                 lambda_short=0.1, independent_beams=10):
+        self.range_table = range_table
+        self.z_hit = z_hit
+        self.z_short = z_short
+        self.z_max = z_max
+        self.z_rand = z_rand
+        self.sigma_hit = sigma_hit
+        self.lambda_short = lambda_short
+        self.independent_beams = independent_beams
+
+    def beam_probabilities(self, ranges, expected):
+        """ Compute the probability of each measured range given the expected range (arrays that broadcast) """
+        max_range = self.range_table.max_range
+        ranges = np.minimum(ranges, max_range)
+        p = np.exp(-0.5*np.square((ranges - expected)/self.sigma_hit))
+        p *= self.z_hit/(self.sigma_hit*np.sqrt(2*np.pi))
+        # an obstacle that is not in the map can only make the range shorter than expected.  Like in amcl the
+        # exponential is not renormalized to the expected range, so this and the rest only depend on the
+        # measured ranges and are computed once per beam.
+        p_short = self.z_short*self.lambda_short*np.exp(-self.lambda_short*ranges)
+        p += np.where(ranges < expected, p_short, 0.0)
+        p += np.where(ranges >= max_range, self.z_max, self.z_rand/max_range)
+        return p
+
+    def weights(self, x, y, theta, ranges, angles, valid=None):
+        """ Compute the (unnormalized) weight of each particle given a scan
+            x, y, theta: arrays of the N particle poses in the map frame
+            ranges, angles: the beams to score, either as arrays of B beams shared by every particle or as
+                            (N, B) arrays (see LikelihoodFieldModel.endpoints)
+            valid: if given, an (N, B) boolean array of the beams each particle is scored with (see
+                   LikelihoodFieldModel.weights)
+            returns: an array of N weights, the (tempered, see independent_beams) product of the probabilities
+                     of the beams, which is 0 for particles that are not in a free cell of the map """
+        headings = np.asarray(theta)[:, np.newaxis] + np.asarray(angles)
+        expected = self.range_table.expected_ranges(x, y, headings)
+        # the product is summed in log space, since it is a product of many small probabilities
+        log_p = np.log(self.beam_probabilities(np.asarray(ranges, dtype=np.float64), expected))
+        if valid is None:
+            n_beams = log_p.shape[1]
+        else:
+            log_p = np.where(valid, log_p, 0.0)
+            n_beams = np.sum(valid, axis=1)
+        log_weights = np.sum(log_p, axis=1)
+        in_map = ~np.isnan(log_weights)
+        if self.independent_beams:
+            # every beam's probability is at least z_rand/max_range, so the tempered weights are bounded
+            log_weights *= float(self.independent_beams)/np.maximum(n_beams, 1)
+        elif np.any(in_map):
+            log_weights -= np.max(log_weights[in_map])
+        weights = np.zeros(len(log_weights))
+        weights[in_map] = np.exp(log_weights[in_map])
+        return weights
+
+
+def valid_beams(ranges, angles, range_min=0.0, range_max=np.inf):
+    """ Remove the beams that did not return a usable range (inf, nan, zero, or outside of the
+        sensor's [range_min, range_max] interval)
+        returns: the (ranges, angles) arrays of the usable beams """
+    ranges = np.asarray(ranges, dtype=np.float64)
+    angles = np.asarray(angles, dtype=np.float64)
+    usable = np.isfinite(ranges) & (ranges > 0) & (ranges >= range_min) & (ranges <= range_max)
+    return ranges[usable], angles[usable]
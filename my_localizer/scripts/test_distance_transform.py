@@ -0,0 +1,64 @@
+""" Checks the exact distance transform against the ball tree nearest neighbour search that the occupancy
+    field used to be built with (sklearn.neighbors.NearestNeighbors), on the bundled maps and on random
+    grids.  Run with: python -m pytest test_distance_transform.py (or python -m unittest) """
+
+import glob
+import os
+import unittest
+
+import numpy as np
+
+from distance_transform import distance_transform
+from map_io import load_map
+from occupancy_field import OccupancyField
+
+try:
+    from sklearn.neighbors import NearestNeighbors
+except ImportError:
+    NearestNeighbors = None
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps')
+
+
+def ball_tree_distances(occupied):
+    """ The distance (in cells) from every cell to the closest occupied cell, computed the way the occupancy
+        field used to: with a ball tree over the coordinates of the occupied cells """
+    rows, cols = np.nonzero(occupied)
+    tree = NearestNeighbors(n_neighbors=1, algorithm="ball_tree").fit(np.column_stack((cols, rows)))
+    all_rows, all_cols = np.indices(occupied.shape)
+    distances, _ = tree.kneighbors(np.column_stack((all_cols.ravel(), all_rows.ravel())))
+    return distances[:, 0].reshape(occupied.shape)
+
+
+@unittest.skipIf(NearestNeighbors is None, "scikit-learn is needed for the reference distances")
+class DistanceTransformTest(unittest.TestCase):
+
+    def test_random_grids(self):
+        random_state = np.random.RandomState(0)
+        for shape, density in [((1, 1), 1.0), ((1, 40), 0.1), ((37, 1), 0.1), ((50, 80), 0.01),
+                               ((64, 64), 0.2), ((120, 90), 0.5)]:
+            occupied = random_state.random_sample(shape) < density
+            occupied.flat[random_state.randint(occupied.size)] = True
+            np.testing.assert_allclose(distance_transform(occupied), ball_tree_distances(occupied), atol=1e-9,
+                                       err_msg="grid of shape %s" % (shape,))
+
+    def test_bundled_maps(self):
+        map_files = sorted(glob.glob(os.path.join(MAPS_DIR, '*.yaml')))
+        self.assertTrue(map_files)
+        for map_file in map_files:
+            field = OccupancyField(load_map(map_file))
+            info = field.map.info
+            occupied = np.asarray(field.map.data).reshape((info.height, info.width)) > 0
+            expected = ball_tree_distances(occupied)*info.resolution
+
+            # look every cell up through the field, at the center of the cell
+            rows, cols = np.indices(occupied.shape)
+            x = info.origin.position.x + (cols + 0.5)*info.resolution
+            y = info.origin.position.y + (rows + 0.5)*info.resolution
+            # the field is stored as float32, so agreement is to float32 precision (far below a cell)
+            np.testing.assert_allclose(field.get_closest_obstacle_distance(x, y), expected,
+                                       rtol=1e-6, atol=1e-6, err_msg=map_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
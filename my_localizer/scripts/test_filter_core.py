@@ -0,0 +1,63 @@
+""" Checks the filter core on synthetic sequences of the bundled maps (see benchmark_pf.synthetic_sequence).
+    Run with: python -m pytest test_filter_core.py (or python -m unittest) """
+
+import math
+import os
+import unittest
+
+import numpy as np
+
+from map_io import load_map
+from occupancy_field import OccupancyField
+from filter_core import ParticleFilterCore
+from benchmark_pf import synthetic_sequence, Scan
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps')
+
+
+def replay(core, sequence, steps):
+    """ Feed the first steps of a sequence to a filter core
+        returns: the distance between the final estimate and the true position, and the number of random
+                 particles that were injected """
+    injected = 0
+    for t in range(1, steps):
+        scan = Scan(sequence['ranges'][t], sequence['angle_min'], sequence['angle_increment'],
+                    sequence['range_min'], sequence['range_max'])
+        core.update(tuple(sequence['odom'][t - 1]), tuple(sequence['odom'][t]), scan)
+        injected += core.filter_stats['injected']
+    x, y, _ = core.robot_xy_theta
+    return math.hypot(x - sequence['truth'][steps - 1][0], y - sequence['truth'][steps - 1][1]), injected
+
+
+class FilterCoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.field = OccupancyField(load_map(os.path.join(MAPS_DIR, 'ac109_3.yaml')))
+        cls.sequence = synthetic_sequence(cls.field, 60, random_state=1)
+
+    def test_recovers_when_lost(self):
+        # every particle starts far outside of the map, so every scan rules all of them out
+        core = ParticleFilterCore(self.field, 500, random_state=0)
+        x, y, theta = self.sequence['truth'][0]
+        core.initialize_particle_cloud((x + 20.0, y + 20.0, theta))
+        error, injected = replay(core, self.sequence, 60)
+        self.assertGreater(injected, 0)
+        self.assertLess(error, 0.5)
+
+    def test_same_seed_same_result(self):
+        results = []
+        for _ in range(2):
+            core = ParticleFilterCore(self.field, 500, random_state=3)
+            core.initialize_particle_cloud(tuple(self.sequence['truth'][0]))
+            replay(core, self.sequence, 20)
+            results.append(core)
+        first, second = results
+        for attribute in ('x', 'y', 'theta', 'w'):
+            np.testing.assert_array_equal(getattr(first.particle_cloud, attribute),
+                                          getattr(second.particle_cloud, attribute))
+        self.assertEqual(first.robot_xy_theta, second.robot_xy_theta)
+
+
+if __name__ == '__main__':
+    unittest.main()
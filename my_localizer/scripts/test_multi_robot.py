@@ -0,0 +1,76 @@
+""" Checks that the laser updates of several robots are scored together, in one call of the sensor model,
+    and give the same weights as scoring every robot on its own.
+    Run with: python -m pytest test_multi_robot.py (or python -m unittest) """
+
+import os
+import unittest
+
+import numpy as np
+
+from map_io import load_map
+from occupancy_field import OccupancyField
+from filter_core import ParticleFilterCore
+from sensor_model import LikelihoodFieldModel
+from multi_robot import batched_laser_update
+from benchmark_pf import synthetic_sequence, Scan
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps')
+
+
+class CountingModel(object):
+    """ Passes the calls on to a sensor model, and remembers how many particles each call scored """
+
+    def __init__(self, sensor_model):
+        self.sensor_model = sensor_model
+        self.calls = []
+
+    def weights(self, x, y, theta, ranges, angles, valid=None):
+        self.calls.append(len(x))
+        return self.sensor_model.weights(x, y, theta, ranges, angles, valid)
+
+
+class BatchedLaserUpdateTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.field = OccupancyField(load_map(os.path.join(MAPS_DIR, 'ac109_1.yaml')))
+        cls.sequence = synthetic_sequence(cls.field, 40, random_state=2)
+
+    def make_robots(self, steps):
+        """ A filter and a scan for each robot, each robot at the true pose of one step of the sequence """
+        cores, scans = [], []
+        for i, t in enumerate(steps):
+            core = ParticleFilterCore(self.field, 200, random_state=i, kld_sampling=False)
+            core.initialize_particle_cloud(tuple(self.sequence['truth'][t]))
+            cores.append(core)
+            scans.append(Scan(self.sequence['ranges'][t], self.sequence['angle_min'],
+                              self.sequence['angle_increment'], self.sequence['range_min'],
+                              self.sequence['range_max']))
+        return cores, scans
+
+    def test_robots_scored_in_one_call(self):
+        steps = [0, 9, 19, 29, 39]
+        cores, scans = self.make_robots(steps)
+        # the scans keep different numbers of beams, so they only share a call when they are padded
+        beam_counts = set(len(core.beam_selector.select(scan)[0]) for core, scan in zip(cores, scans))
+        self.assertGreater(len(beam_counts), 1)
+
+        sensor_model = CountingModel(LikelihoodFieldModel(self.field))
+        batched_laser_update(cores, scans, sensor_model, max_batch=len(steps)*200)
+        self.assertEqual(sensor_model.calls, [len(steps)*200])
+
+        # the same seeds give the same particles
+        alone, _ = self.make_robots(steps)
+        for core, other, scan in zip(cores, alone, scans):
+            other.update_particles_with_laser(scan)
+            np.testing.assert_allclose(core.particle_cloud.w, other.particle_cloud.w, rtol=1e-12)
+
+    def test_max_batch(self):
+        cores, scans = self.make_robots([0, 9, 19, 29, 39])
+        sensor_model = CountingModel(LikelihoodFieldModel(self.field))
+        batched_laser_update(cores, scans, sensor_model, max_batch=400)
+        self.assertEqual(sensor_model.calls, [400, 400, 200])
+
+
+if __name__ == '__main__':
+    unittest.main()